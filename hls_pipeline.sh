@@ -276,13 +276,15 @@ echo "================================================================="
         #   - 27-tile, 3-VI, 3,876-granule run (PA Mountain Laurel, winter 2015–2021)
         # Steps 01–03 per-granule sizes:
         TBT_RAW_PER_GRANULE=45           # ~3 raw band TIFs (HLS int16 COGs); ~41 MB measured
-        TBT_VI_PER_GRANULE=15            # float32 LZW per granule per VI; ~8–11 MB measured
+        TBT_VI_PER_GRANULE=15            # float32 per granule per VI; ~8–11 MB measured with LZW
         TBT_NC_PER_GRANULE=12            # zlib-compressed NC; ~6–8 MB/granule/VI measured (7x
                                          #   smaller than uncompressed due to NaN-heavy scenes)
-        # Steps 04–11 per-tile output sizes (LZW-compressed):
+        # Steps 04–11 per-tile output sizes (measured with LZW; ZSTD is typically smaller):
         TBT_MEAN_TILE_MB=55              # per-tile mean reprojected GeoTIFF; ~53 MB measured (PA)
         TBT_OUTLIER_TILE_MB=5            # per-tile outlier mean + count; highly data-dependent —
                                          #   nearly 0 for NDVI [-1,1], higher for tighter ranges
+        TBT_VALID_COUNT_TILE_MB=10       # per-tile step 05 valid-count tile (uint16, dense and
+                                         #   data-independent); ~0.75 B/px, ~10 MB per 3660² tile
         TBT_MOSAIC_FLOAT_PER_TILE_MB=35  # per-tile contribution to a float32 mosaic; ~34 MB measured (PA)
         TBT_MOSAIC_INT_PER_TILE_MB=3     # per-tile contribution to a uint16 mosaic; ~3 MB measured
         TBT_TS_PER_TILE_WIN_MB=50        # per-tile per-window time-series: mean+count; ~49 MB measured (PA)
@@ -353,7 +355,8 @@ echo "================================================================="
             tbt_ds_step04_mb=$(( tbt_n_tiles * tbt_vis_count * TBT_MEAN_TILE_MB ))
         fi
         if step_active "outlier_flat"; then
-            tbt_ds_step05_mb=$(( tbt_n_tiles * tbt_vis_count * TBT_OUTLIER_TILE_MB ))
+            tbt_ds_step05_mb=$(( tbt_n_tiles * tbt_vis_count * \
+                                 (TBT_OUTLIER_TILE_MB + TBT_VALID_COUNT_TILE_MB) ))
         fi
         if step_active "mean_mosaic"; then
             tbt_ds_step06_mb=$(( tbt_n_tiles * tbt_vis_count * TBT_MOSAIC_FLOAT_PER_TILE_MB ))
@@ -17,21 +17,60 @@ import numpy as np
 import rasterio
 from rasterio.transform import from_bounds
 from rasterio.crs import CRS
-import glob
 from pathlib import Path
 import multiprocessing as mp
 import warnings
-from hls_utils import filter_by_configured_tiles, setup_logging
+from contextlib import ExitStack
+from numba import njit, prange
+from hls_kernels import set_worker_threads
+from hls_utils import filter_by_configured_tiles, find_files, gdal_env, geotiff_options, setup_logging
 
 logger = setup_logging("02_vi_calc")
 
 # Suppress "NotGeoreferencedWarning" which can be spammy with HLS data
 warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarning)
 
-GEOTIFF_COMPRESS = os.environ.get("GEOTIFF_COMPRESS", "LZW").upper()
+
+# error_model='numpy' keeps IEEE semantics for x/0 and 0/0 (inf/nan instead of
+# ZeroDivisionError). fastmath is deliberately off: it assumes no nan/inf, and
+# inf/nan values produced here are intentional — they are physically
+# implausible and will be caught by the valid-range filter in steps 04/05.
+@njit(parallel=True, cache=True, error_model='numpy')
+def _vi_kernel(red, nir, fmask, lut, scale, out_ndvi, out_evi2, out_nirv):
+    """Fused scale + Fmask mask + NDVI/EVI2/NIRv over one 2-D raster.
+
+    red/nir are the raw integer reflectance bands; ``scale`` (float32)
+    converts them to surface reflectance inside the loop. Reads each
+    red/nir/fmask pixel once and writes the three float32 outputs directly,
+    with no intermediate full-size arrays. Pixels where ``lut[fmask]`` is
+    True are written as NaN in all three outputs. All arithmetic is float32,
+    as in the former whole-array numpy version.
+    """
+    h, w = red.shape
+    for i in prange(h):
+        for j in range(w):
+            if lut[fmask[i, j]]:
+                out_ndvi[i, j] = np.nan
+                out_evi2[i, j] = np.nan
+                out_nirv[i, j] = np.nan
+                continue
+            r = red[i, j] * scale
+            n = nir[i, j] * scale
+            # NIRv = NDVI * NIR reuses the in-register ndvi and n; the
+            # difference is shared by NDVI and EVI2.
+            diff = n - r
+            ndvi = diff / (n + r)
+            out_ndvi[i, j] = ndvi
+            out_evi2[i, j] = (np.float32(2.5) * diff
+                              / (n + np.float32(2.4) * r + np.float32(1.0)))
+            out_nirv[i, j] = ndvi * n
+
 
 class HLSProcessor:
     def __init__(self, s30_dir, l30_dir, output_dir, wanted_vis=None):
+        # Kept so workers can rebuild an identical processor in _init_worker
+        self.init_args = dict(s30_dir=s30_dir, l30_dir=l30_dir,
+                              output_dir=output_dir, wanted_vis=wanted_vis)
         self.s30_dir = s30_dir
         self.l30_dir = l30_dir
         self.output_dir = output_dir
@@ -51,15 +90,45 @@ class HLSProcessor:
         
         # Scale factor
         self.scale_factor = float(os.environ.get("HLS_SCALE_FACTOR", 0.0001))
+
+        # Fmask is uint8, so the whole mask policy fits in a 256-entry table
+        self._fmask_lut = self._build_fmask_lut()
+
+        # Pool size, set by _init_worker; splits gdal_env's threads and cache
+        self.n_workers = 1
         
         os.makedirs(self.output_dir, exist_ok=True)
         
+    def _build_fmask_lut(self):
+        """Return a 256-entry boolean table: True where an Fmask value is masked.
+
+        Encodes the per-bit flags, the aerosol threshold and the 255 fill value
+        once, so masking a granule is a single lookup ``lut[fmask]`` instead of
+        one full-array pass per flag.
+        """
+        bit_flags = [self.mask_cirrus, self.mask_cloud, self.mask_adj,
+                     self.mask_shadow, self.mask_snow, self.mask_water]
+        # Minimum aerosol level (bits 6-7) that is masked; None = no aerosol mask
+        aerosol_threshold = {"LOW": 1, "MODERATE": 2, "HIGH": 3}.get(self.aerosol_mode)
+
+        lut = np.zeros(256, dtype=bool)
+        for v in range(256):
+            masked = any(flag and (v >> bit) & 1 for bit, flag in enumerate(bit_flags))
+            if aerosol_threshold is not None and ((v >> 6) & 0b11) >= aerosol_threshold:
+                masked = True
+            # Mask the structural NoData fill value (255) only.
+            # Negative reflectance and other physically implausible values
+            # are intentionally passed through — they produce inf/nan in the
+            # VI math, which the valid-range filter in steps 04/05 masks.
+            if v == 255:
+                masked = True
+            lut[v] = masked
+        return lut
+
     def find_granules(self, base_dir, product_type):
         granules = []
         logger.info(f"Scanning {product_type} directory recursively...")
-        search_pattern = os.path.join(base_dir, "**", "*Fmask.tif")
-        fmask_files = glob.glob(search_pattern, recursive=True)
-        fmask_files = filter_by_configured_tiles(fmask_files)
+        fmask_files = filter_by_configured_tiles(list(find_files(base_dir, "Fmask.tif")))
 
         logger.info(f"  Found {len(fmask_files)} {product_type} granules.")
         
@@ -87,97 +156,60 @@ class HLSProcessor:
                 })
         return granules
 
-    def calculate_indices(self, red, nir):
-        # np.errstate suppresses console warnings for 0/0 and x/0 operations.
-        # inf and nan values produced here are intentional — they are physically
-        # implausible and will be caught by the valid-range filter in steps 04/05.
-        with np.errstate(divide='ignore', invalid='ignore'):
-            # NDVI
-            ndvi_denom = nir + red
-            ndvi = (nir - red) / ndvi_denom
-            
-            # EVI2
-            evi2_denom = nir + 2.4 * red + 1
-            evi2 = 2.5 * (nir - red) / evi2_denom
-            
-            # NIRv
-            nirv = ndvi * nir
-            
-        return ndvi, evi2, nirv
-
     def process_granule_static(self, granule_info):
+        opened = []   # outputs created by this call, removed again on failure
         try:
             basename = granule_info['basename']
             
-            needed_outputs = []
-            if "NDVI" in self.wanted_vis: needed_outputs.append(os.path.join(self.output_dir, f"{basename}.NDVI.tif"))
-            if "EVI2" in self.wanted_vis: needed_outputs.append(os.path.join(self.output_dir, f"{basename}.EVI2.tif"))
-            if "NIRv" in self.wanted_vis: needed_outputs.append(os.path.join(self.output_dir, f"{basename}.NIRv.tif"))
+            outputs = {vi: os.path.join(self.output_dir, f"{basename}.{vi}.tif")
+                       for vi in ("NDVI", "EVI2", "NIRv") if vi in self.wanted_vis}
             
-            if all(os.path.exists(p) for p in needed_outputs):
+            if all(os.path.exists(p) for p in outputs.values()):
                 return f"Skipped (Exists): {basename}"
 
-            with rasterio.open(granule_info['red']) as src_red, \
-                 rasterio.open(granule_info['nir']) as src_nir, \
-                 rasterio.open(granule_info['fmask']) as src_fmask:
-                
-                red = src_red.read(1).astype('float32')
-                nir = src_nir.read(1).astype('float32')
-                fmask = src_fmask.read(1)
+            with gdal_env(self.n_workers), ExitStack() as stack:
+                src_red   = stack.enter_context(rasterio.open(granule_info['red']))
+                src_nir   = stack.enter_context(rasterio.open(granule_info['nir']))
+                src_fmask = stack.enter_context(rasterio.open(granule_info['fmask']))
                 profile = src_red.profile
-                
-                red = red * self.scale_factor
-                nir = nir * self.scale_factor
-                
-                # --- QUALITY MASKING ---
-                mask = np.zeros(fmask.shape, dtype=bool)
-
-                if self.mask_cirrus: mask |= ((fmask & (1 << 0)) > 0)
-                if self.mask_cloud:  mask |= ((fmask & (1 << 1)) > 0)
-                if self.mask_adj:    mask |= ((fmask & (1 << 2)) > 0)
-                if self.mask_shadow: mask |= ((fmask & (1 << 3)) > 0)
-                if self.mask_snow:   mask |= ((fmask & (1 << 4)) > 0)
-                if self.mask_water:  mask |= ((fmask & (1 << 5)) > 0)
-                
-                aerosol_level = (fmask >> 6) & 0b11
-                
-                if self.aerosol_mode == "LOW":
-                    mask |= (aerosol_level >= 1)
-                elif self.aerosol_mode == "MODERATE":
-                    mask |= (aerosol_level >= 2)
-                elif self.aerosol_mode == "HIGH":
-                    mask |= (aerosol_level == 3)
-
-                # Mask the structural NoData fill value (255) only.
-                # Negative reflectance and other physically implausible values
-                # are intentionally passed through — they produce inf/nan in the
-                # VI math above, which the valid-range filter in steps 04/05 masks.
-                mask |= (fmask == 255)
-
-                red[mask] = np.nan
-                nir[mask] = np.nan
-                
-                # Calculate Indices
-                ndvi, evi2, nirv = self.calculate_indices(red, nir)
-                
-                profile.update(dtype=rasterio.float32, nodata=np.nan, count=1, compress=GEOTIFF_COMPRESS)
-                
-                # Write outputs
-                if "NDVI" in self.wanted_vis:
-                    with rasterio.open(os.path.join(self.output_dir, f"{basename}.NDVI.tif"), 'w', **profile) as dst:
-                        dst.write(ndvi, 1)
-                    
-                if "EVI2" in self.wanted_vis:
-                    with rasterio.open(os.path.join(self.output_dir, f"{basename}.EVI2.tif"), 'w', **profile) as dst:
-                        dst.write(evi2, 1)
-                        
-                if "NIRv" in self.wanted_vis:
-                    with rasterio.open(os.path.join(self.output_dir, f"{basename}.NIRv.tif"), 'w', **profile) as dst:
-                        dst.write(nirv, 1)
+
+                # Tiled output (rather than the source's layout) so the block-aligned
+                # reads in steps 03/04 hit whole compressed tiles.
+                profile.update(
+                    dtype=rasterio.float32, nodata=np.nan, count=1,
+                    **geotiff_options('float32'),   # predictor 3: float differencing
+                    BIGTIFF='IF_SAFER',
+                )
+                dsts = {}
+                for vi, path in outputs.items():
+                    dsts[vi] = stack.enter_context(rasterio.open(path, 'w', **profile))
+                    opened.append(path)
+
+                # --- QUALITY MASKING + INDICES (block-wise, single fused pass) ---
+                # Walk the output's tile grid so each write fills exactly one
+                # tile; only one block of each band is held in memory at a time.
+                # Bands stay in their native integer dtype; _vi_kernel applies
+                # the scale factor per pixel.
+                for _, window in next(iter(dsts.values())).block_windows(1):
+                    red   = src_red.read(1, window=window)
+                    nir   = src_nir.read(1, window=window)
+                    fmask = src_fmask.read(1, window=window)
+
+                    vis = {vi: np.empty(red.shape, dtype=np.float32) for vi in ("NDVI", "EVI2", "NIRv")}
+                    _vi_kernel(red, nir, fmask, self._fmask_lut, np.float32(self.scale_factor),
+                               vis["NDVI"], vis["EVI2"], vis["NIRv"])
+
+                    for vi, dst in dsts.items():
+                        dst.write(vis[vi], 1, window=window)
 
             return f"Processed: {basename}"
             
         except Exception as e:
+            # Outputs are opened before the data is computed; drop partial files
+            # so a rerun does not skip this granule as already done.
+            for path in opened:
+                if os.path.exists(path):
+                    os.remove(path)
             return f"Error processing {granule_info.get('basename', 'unknown')}: {str(e)}"
 
     def process_all_data_parallel(self, n_workers=4, chunk_size=1):
@@ -191,9 +223,18 @@ class HLSProcessor:
             logger.warning("No granules found.")
             return
 
-        logger.info(f"Starting pool with {n_workers} workers...")
-        with mp.Pool(processes=n_workers) as pool:
-            results = pool.imap_unordered(self.process_granule_static, all_granules, chunksize=chunk_size)
+        # CHUNK_SIZE=1 (the default) means "pick automatically": ~16 batches
+        # per worker balances the load, and at least 4 granules per batch
+        # amortizes dispatch and result pickling for sub-second granules.
+        if chunk_size <= 1:
+            chunk_size = max(4, len(all_granules) // (n_workers * 16))
+
+        logger.info(f"Starting pool with {n_workers} workers (chunksize {chunk_size})...")
+        with mp.Pool(processes=n_workers, initializer=_init_worker,
+                     initargs=(self.init_args, n_workers)) as pool:
+            # Only the small granule_info dicts are pickled per task; the
+            # processor itself is built once per worker by _init_worker.
+            results = pool.imap_unordered(_run_granule, all_granules, chunksize=chunk_size)
             count = 0
             for res in results:
                 count += 1
@@ -201,6 +242,23 @@ class HLSProcessor:
                 elif "Error"   in res: logger.error(f"  [{count}/{len(all_granules)}] {res}")
                 elif "Skipped" in res: logger.info(f"  [{count}/{len(all_granules)}] {res}")
 
+# Per-worker processor, set once by _init_worker when the pool starts
+_WORKER = None
+
+
+def _init_worker(init_args, n_workers):
+    global _WORKER
+    _WORKER = HLSProcessor(**init_args)
+    _WORKER.n_workers = n_workers
+    # Numba threads used by _vi_kernel, capped so N workers do not
+    # oversubscribe cores.
+    set_worker_threads(n_workers)
+
+
+def _run_granule(granule_info):
+    return _WORKER.process_granule_static(granule_info)
+
+
 if __name__ == "__main__":
     try: mp.set_start_method('fork', force=True)
     except RuntimeError: pass
@@ -11,23 +11,32 @@
 # License: MIT
 
 import os
+import re
 import numpy as np
 import netCDF4 as nc4
 import rasterio
 from rasterio.crs import CRS
+from rasterio.windows import Window
 from pyproj import CRS as ProjCRS
 import pandas as pd
 from pathlib import Path
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 import warnings
 import glob
-from hls_utils import get_configured_tiles, setup_logging
+from hls_utils import gdal_env, get_configured_tiles, read_shared_array, setup_logging, share_array
 
 logger = setup_logging("03_netcdf_build")
 
 warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarning)
 
 
+# VI GeoTIFF names from step 02: HLS.<sensor>.<tile>.<YYYYDDD>T<hhmmss>.<version…>.<VI>.tif
+# Groups: sensor, tile_id, YYYYDDD, VI.
+_VI_NAME_RE = re.compile(r'^[^.]*\.([^.]+)\.([^.]+)\.(\d{7})[^.]*(?:\.[^.]*)+\.([^.]+)\.tif$')
+
+
 def _grid_mapping_name(wkt: str) -> str:
     """Return the CF grid_mapping_name for a CRS WKT string."""
     try:
@@ -35,6 +44,50 @@ def _grid_mapping_name(wkt: str) -> str:
     except Exception:
         return "crs"
 
+# HDF5 chunk shape for the VI variable: up to NC_TIME_CHUNK time steps by
+# NC_SPATIAL_CHUNK² pixels. Without explicit chunksizes netCDF4 picks a
+# layout that forces whole-scene decompression for temporal reads.
+NC_TIME_CHUNK    = 32
+NC_SPATIAL_CHUNK = 512
+
+
+def _create_vi_var(nc, vi_type, n_times, height, width, compression, complevel):
+    """Create the (time, y, x) float32 VI variable with explicit chunking.
+
+    ``compression`` is any codec accepted by netCDF4 ≥ 1.6 (``zlib``,
+    ``zstd``, ``blosc_lz4``, …) or ``none``. The HDF5 shuffle filter is
+    requested as well; netCDF4 applies it in front of zlib, where it helps
+    float32 data considerably.
+    """
+    chunks = (max(1, min(n_times, NC_TIME_CHUNK)),
+              min(height, NC_SPATIAL_CHUNK), min(width, NC_SPATIAL_CHUNK))
+    if compression == 'none':
+        return nc.createVariable(vi_type, 'f4', ('time', 'y', 'x'), chunksizes=chunks,
+                                 fill_value=np.nan)
+    return nc.createVariable(vi_type, 'f4', ('time', 'y', 'x'), chunksizes=chunks,
+                             compression=compression, complevel=complevel, shuffle=True,
+                             fill_value=np.nan)
+
+
+def _read_block(srcs, window, n_workers):
+    """Read *window* of every open granule into a (t, rows, cols) float32 array.
+
+    Entries of *srcs* that are None (unreadable or mismatched granules) and
+    granules whose read fails are left as NaN. Runs in the reader thread,
+    which opens its own GDAL environment (rasterio.Env is thread-local).
+    """
+    buf = np.full((len(srcs), window.height, window.width), np.nan, dtype=np.float32)
+    with gdal_env(n_workers):
+        for k, src in enumerate(srcs):
+            if src is None:
+                continue
+            try:
+                buf[k] = src.read(1, window=window)
+            except Exception:
+                pass
+    return buf
+
+
 def process_netcdf_chunk(chunk_info):
     # Worker function (Must be top-level)
     try:
@@ -43,9 +96,9 @@ def process_netcdf_chunk(chunk_info):
         tile_id = chunk_info['tile_id']
         vi_type = chunk_info['vi_type']
         output_folder = Path(chunk_info['output_folder'])
-        # x/y coords are passed as lists/arrays
-        x_coords = chunk_info['x_coords']
-        y_coords = chunk_info['y_coords']
+        # x/y coords arrive as shared-memory specs (see share_array)
+        x_coords = read_shared_array(chunk_info['x_coords'])
+        y_coords = read_shared_array(chunk_info['y_coords'])
         # CRS info
         crs_wkt = chunk_info.get('crs_wkt', "")
         
@@ -65,7 +118,8 @@ def process_netcdf_chunk(chunk_info):
         # Convert to days since epoch
         time_values = [(d - pd.Timestamp('1970-01-01')).days for d in dates]
         
-        with nc4.Dataset(output_path, 'w', format='NETCDF4') as nc:
+        n_workers = chunk_info.get('n_workers', 1)
+        with gdal_env(n_workers), nc4.Dataset(output_path, 'w', format='NETCDF4') as nc:
             # Create Dimensions
             nc.createDimension('time', len(files))
             nc.createDimension('y', height)
@@ -103,24 +157,52 @@ def process_netcdf_chunk(chunk_info):
             crs_var.long_name = 'CRS definition'
             
             # Data Variable
-            vi_var = nc.createVariable(vi_type, 'f4', ('time', 'y', 'x'), zlib=True, complevel=chunk_info.get('complevel', 1), fill_value=np.nan)
+            vi_var = _create_vi_var(nc, vi_type, len(files), height, width,
+                                    chunk_info.get('compression', 'zlib'),
+                                    chunk_info.get('complevel', 1))
             vi_var.grid_mapping = 'spatial_ref' # Link data to CRS variable
             
             sensor_var = nc.createVariable('sensor', 'S3', ('time',))
             
-            for i, f_info in enumerate(files):
+            # Write whole HDF5 chunks: for each group of time steps, read one
+            # chunk-sized window from every granule into a (t, rows, cols)
+            # buffer and assign it in a single call, instead of one
+            # full-scene slice per time step. A buffer is one HDF5 chunk
+            # (≤ NC_TIME_CHUNK × NC_SPATIAL_CHUNK² float32 = 32 MB), and at
+            # most two are alive per worker.
+            t_chunk, row_chunk, col_chunk = vi_var.chunking()
+            for t0 in range(0, len(files), t_chunk):
+                group = files[t0:t0 + t_chunk]
+                srcs = []
+                for i, f_info in enumerate(group):
+                    try:
+                        src = rasterio.open(f_info['file_path'])
+                    except Exception:
+                        srcs.append(None)
+                        continue
+                    # Handle edge case where a granule might have different extent (rare in HLS Tiled)
+                    srcs.append(src if src.shape == (height, width) else None)
+                    sensor_var[t0 + i] = f_info['sensor']
+                # One reader thread decodes the next block while this
+                # thread writes the current one (GDAL and netCDF4 both
+                # release the GIL). Only the reader thread touches srcs.
+                windows = [Window(c0, r0, min(col_chunk, width - c0), min(row_chunk, height - r0))
+                           for r0 in range(0, height, row_chunk)
+                           for c0 in range(0, width, col_chunk)]
                 try:
-                    with rasterio.open(f_info['file_path']) as src:
-                        data = src.read(1)
-                        # Basic shape check
-                        if data.shape == (height, width):
-                             vi_var[i, :, :] = data
-                        else:
-                             # Handle edge case where a granule might have different extent (rare in HLS Tiled)
-                             vi_var[i, :, :] = np.nan
-                        sensor_var[i] = f_info['sensor']
-                except:
-                    vi_var[i, :, :] = np.nan
+                    with ThreadPoolExecutor(max_workers=1) as reader:
+                        pending = reader.submit(_read_block, srcs, windows[0], n_workers)
+                        for n, window in enumerate(windows):
+                            buf = pending.result()
+                            if n + 1 < len(windows):
+                                pending = reader.submit(_read_block, srcs, windows[n + 1], n_workers)
+                            vi_var[t0:t0 + len(group),
+                                   window.row_off:window.row_off + window.height,
+                                   window.col_off:window.col_off + window.width] = buf
+                finally:
+                    for src in srcs:
+                        if src is not None:
+                            src.close()
             
             # Global Attributes
             nc.Conventions = 'CF-1.8'
@@ -138,35 +220,23 @@ class HLSNetCDFAggregator:
         self.output_folder.mkdir(parents=True, exist_ok=True)
         self.vegetation_indices = wanted_vis if wanted_vis else ['NDVI', 'EVI2', 'NIRv']
         self.netcdf_complevel = int(os.environ.get("NETCDF_COMPLEVEL", 1))
+        self.netcdf_compression = os.environ.get("NETCDF_COMPRESSION", "zlib").lower()
         
-    def extract_metadata_from_filename(self, filename):
-        name = filename.name
-        # Expecting: HLS.L30.T18TVL.2020081T154931.v2.0.NDVI.tif
-        try:
-            parts = name.split('.')
-            if len(parts) >= 7:
-                sensor = parts[1] # L30 or S30
-                tile_id = parts[2] # T18TVL
-                date_str = parts[3] # 2020081T...
-                
-                # Check if the VI is in the filename (usually near the end)
-                # The generic structure might put VI at index 6 or -2
-                vi_candidate = parts[-2]
-                
-                if vi_candidate in self.vegetation_indices:
-                     vi_type = vi_candidate
-                else:
-                     return None, None, None, None
+    def parse_filenames(self, tif_files):
+        """Parse (path, sensor, tile_id, date, vi_type) for every VI GeoTIFF in *tif_files*.
 
-                # Parse Date
-                year = int(date_str[:4])
-                doy = int(date_str[4:7])
-                date = pd.to_datetime(f"{year}-{doy:03d}", format="%Y-%j")
-                
-                return sensor, tile_id, date, vi_type
-        except: 
-            pass
-        return None, None, None, None
+        Files that do not match the naming scheme, carry an unwanted VI or an
+        invalid acquisition date are dropped. All dates are parsed in one
+        vectorized pd.to_datetime call.
+        """
+        # Expecting: HLS.L30.T18TVL.2020081T154931.v2.0.NDVI.tif
+        matches = [(f, m) for f in tif_files if (m := _VI_NAME_RE.match(f.name))
+                   and m.group(4) in self.vegetation_indices]
+        if not matches:
+            return []
+        dates = pd.to_datetime([m.group(3) for _, m in matches], format="%Y%j", errors="coerce")
+        return [(f, m.group(1), m.group(2), date, m.group(4))
+                for (f, m), date in zip(matches, dates) if not pd.isna(date)]
 
     def merge_chunks(self, tile_id, vi_type, chunk_files):
         logger.info(f"  Merging {len(chunk_files)} chunks for {tile_id} {vi_type}...")
@@ -230,20 +300,39 @@ class HLSNetCDFAggregator:
                     crs_var.grid_mapping_name = _grid_mapping_name(crs_wkt)
                     crs_var.long_name = 'CRS definition'
 
-                vi_var = dst.createVariable(vi_type, 'f4', ('time', 'y', 'x'), zlib=True, complevel=self.netcdf_complevel, fill_value=np.nan)
+                vi_var = _create_vi_var(dst, vi_type, total_time, len(y_coords), len(x_coords),
+                                        self.netcdf_compression, self.netcdf_complevel)
                 if has_spatial_ref: vi_var.grid_mapping = 'spatial_ref'
                 
                 s_var = dst.createVariable('sensor', 'S3', ('time',))
                 
                 # copy data
-                current_t = 0
-                for cf in chunk_files:
-                    with nc4.Dataset(cf, 'r') as src:
+                with ExitStack() as stack:
+                    srcs = [stack.enter_context(nc4.Dataset(cf, 'r')) for cf in chunk_files]
+                    offsets = np.cumsum([0] + [len(src.dimensions['time']) for src in srcs])
+                    for src, t_start in zip(srcs, offsets):
+                        src.set_auto_mask(False)
                         t_len = len(src.dimensions['time'])
-                        t_var[current_t:current_t+t_len] = src.variables['time'][:]
-                        vi_var[current_t:current_t+t_len,:,:] = src.variables[vi_type][:]
-                        s_var[current_t:current_t+t_len] = src.variables['sensor'][:]
-                        current_t += t_len
+                        t_var[t_start:t_start+t_len] = src.variables['time'][:]
+                        s_var[t_start:t_start+t_len] = src.variables['sensor'][:]
+
+                    # Fill one destination HDF5 chunk row at a time: gather
+                    # the (time group, row band) block from every chunk file
+                    # that overlaps it, then write it in a single assignment.
+                    # Peak memory is one block, not a whole chunk file, and
+                    # no destination chunk is compressed more than once.
+                    t_chunk, row_chunk = vi_var.chunking()[:2]
+                    height, width = len(y_coords), len(x_coords)
+                    for t0 in range(0, total_time, t_chunk):
+                        t1 = min(t0 + t_chunk, total_time)
+                        for r0 in range(0, height, row_chunk):
+                            r1 = min(r0 + row_chunk, height)
+                            buf = np.empty((t1 - t0, r1 - r0, width), dtype=np.float32)
+                            for src, s0, s1 in zip(srcs, offsets[:-1], offsets[1:]):
+                                lo, hi = max(t0, s0), min(t1, s1)
+                                if lo < hi:
+                                    buf[lo - t0:hi - t0] = src.variables[vi_type][lo - s0:hi - s0, r0:r1, :]
+                            vi_var[t0:t1, r0:r1, :] = buf
                 
                 dst.Conventions = 'CF-1.8'
                 dst.title = f'HLS {vi_type} {tile_id}'
@@ -266,24 +355,21 @@ class HLSNetCDFAggregator:
         tif_files = list(self.input_folder.glob("**/*.tif"))
         logger.info(f"  Found {len(tif_files)} total .tif files.")
         
-        for f in tif_files:
-            sensor, tile_id, date, vi_type = self.extract_metadata_from_filename(f)
+        configured = get_configured_tiles()
+        for f, sensor, tile_id, date, vi_type in self.parse_filenames(tif_files):
+            bare = tile_id[1:] if tile_id.startswith('T') else tile_id
+            if configured and bare not in configured:
+                continue
+            if tile_id not in file_org: file_org[tile_id] = {}
+            if vi_type not in file_org[tile_id]: file_org[tile_id][vi_type] = []
             
-            if tile_id and date and vi_type:
-                bare = tile_id[1:] if tile_id.startswith('T') else tile_id
-                configured = get_configured_tiles()
-                if configured and bare not in configured:
-                    continue
-                if tile_id not in file_org: file_org[tile_id] = {}
-                if vi_type not in file_org[tile_id]: file_org[tile_id][vi_type] = []
-                
-                file_org[tile_id][vi_type].append({
-                    'file_path': str(f), 
-                    'sensor': sensor, 
-                    'date': date, 
-                    'tile_id': tile_id, 
-                    'vi_type': vi_type
-                })
+            file_org[tile_id][vi_type].append({
+                'file_path': str(f), 
+                'sensor': sensor, 
+                'date': date, 
+                'tile_id': tile_id, 
+                'vi_type': vi_type
+            })
         
         # Sort by date
         for t in file_org:
@@ -291,6 +377,51 @@ class HLSNetCDFAggregator:
                 file_org[t][v].sort(key=lambda x: x['date'])
         return file_org
 
+    def tile_grid(self, tile_id, first_file):
+        """Return (x_coords, y_coords, crs_wkt, shape) for a tile from one of its GeoTIFFs.
+
+        All VIs of a tile share the same grid, so this is computed once per tile.
+        """
+        with gdal_env(), rasterio.open(first_file) as src:
+            transform = src.transform
+            crs = src.crs
+            shape = src.shape
+            crs_wkt = ProjCRS.from_user_input(crs).to_wkt()
+            width = src.width
+            height = src.height
+            
+            # Pixel-center coordinates.
+            # transform.c / transform.f are the TOP-LEFT CORNER of pixel (0,0).
+            # Center of pixel i = corner + pixel_size * (i + 0.5)
+            x_coords = transform.c + transform.a * (np.arange(width)  + 0.5)
+            y_coords = transform.f + transform.e * (np.arange(height) + 0.5)
+
+        # Correct CRS and y-coordinates for southern hemisphere tiles.
+        # HLS v2.0 GeoTIFFs for tiles south of the equator are stored
+        # using a UTM North zone (EPSG:326xx, false_northing=0) with
+        # negative northings rather than the standard UTM South convention
+        # (EPSG:327xx, false_northing=10,000,000). Detect this case and
+        # convert: add 100 to the EPSG zone number to get the UTM South
+        # equivalent, then shift y-coordinates by +10,000,000 m so all
+        # downstream tools (GIS apps, CF-1.8 validators, pyproj) correctly
+        # identify the data as southern hemisphere.
+        try:
+            _epsg = ProjCRS.from_wkt(crs_wkt).to_epsg(min_confidence=20)
+            if _epsg is not None and 32601 <= _epsg <= 32660 and y_coords.mean() < 0:
+                _south_epsg = _epsg + 100   # e.g. 32634 → 32734
+                crs_wkt = ProjCRS.from_epsg(_south_epsg).to_wkt()
+                y_coords = y_coords + 10_000_000.0
+                logger.info(
+                    f"[CRS] {tile_id}: southern hemisphere tile, remapped "
+                    f"EPSG:{_epsg} → EPSG:{_south_epsg} (UTM South)"
+                )
+        except Exception as _crs_err:
+            logger.warning(
+                f"[CRS] {tile_id}: hemisphere check failed ({_crs_err}) — "
+                f"using original CRS unchanged"
+            )
+        return x_coords, y_coords, crs_wkt, shape
+
     def run(self, chunk_size=10, n_workers=4):
         file_org = self.collect_files()
         if not file_org:
@@ -299,92 +430,82 @@ class HLSNetCDFAggregator:
 
         for tile_id in sorted(file_org.keys()):
             logger.info(f"Processing tile: {tile_id}")
-            for vi_type in sorted(file_org[tile_id].keys()):
-                files = file_org[tile_id][vi_type]
-                logger.info(f"  {vi_type}: {len(files)} granules")
-                
-                # Get Spatial Ref from the first file
+            vi_types = sorted(file_org[tile_id].keys())
+
+            # Get Spatial Ref from the first readable file of any VI
+            grid, grid_err = None, None
+            for vi_type in vi_types:
                 try:
-                    with rasterio.open(files[0]['file_path']) as src:
-                        transform = src.transform
-                        crs = src.crs
-                        shape = src.shape
-                        crs_wkt = ProjCRS.from_user_input(crs).to_wkt()
-                        width = src.width
-                        height = src.height
-                        
-                        # Pixel-center coordinates.
-                        # transform.c / transform.f are the TOP-LEFT CORNER of pixel (0,0).
-                        # Center of pixel i = corner + pixel_size * (i + 0.5)
-                        x_coords = transform.c + transform.a * (np.arange(width)  + 0.5)
-                        y_coords = transform.f + transform.e * (np.arange(height) + 0.5)
-
-                    # Correct CRS and y-coordinates for southern hemisphere tiles.
-                    # HLS v2.0 GeoTIFFs for tiles south of the equator are stored
-                    # using a UTM North zone (EPSG:326xx, false_northing=0) with
-                    # negative northings rather than the standard UTM South convention
-                    # (EPSG:327xx, false_northing=10,000,000). Detect this case and
-                    # convert: add 100 to the EPSG zone number to get the UTM South
-                    # equivalent, then shift y-coordinates by +10,000,000 m so all
-                    # downstream tools (GIS apps, CF-1.8 validators, pyproj) correctly
-                    # identify the data as southern hemisphere.
-                    try:
-                        _epsg = ProjCRS.from_wkt(crs_wkt).to_epsg(min_confidence=20)
-                        if _epsg is not None and 32601 <= _epsg <= 32660 and y_coords.mean() < 0:
-                            _south_epsg = _epsg + 100   # e.g. 32634 → 32734
-                            crs_wkt = ProjCRS.from_epsg(_south_epsg).to_wkt()
-                            y_coords = y_coords + 10_000_000.0
-                            logger.info(
-                                f"[CRS] {tile_id}: southern hemisphere tile, remapped "
-                                f"EPSG:{_epsg} → EPSG:{_south_epsg} (UTM South)"
-                            )
-                    except Exception as _crs_err:
-                        logger.warning(
-                            f"[CRS] {tile_id}: hemisphere check failed ({_crs_err}) — "
-                            f"using original CRS unchanged"
-                        )
-
-                    # Create Chunks
-                    chunks = []
-                    total_chunks = (len(files) + chunk_size - 1) // chunk_size
-                    
-                    for i, start_idx in enumerate(range(0, len(files), chunk_size)):
-                        chunk_files = files[start_idx : start_idx + chunk_size]
-                        chunks.append({
-                            'chunk_id': i + 1,
-                            'total_chunks': total_chunks,
-                            'files': chunk_files,
-                            'tile_id': tile_id,
-                            'vi_type': vi_type,
-                            'output_folder': str(self.output_folder),
-                            'x_coords': x_coords,
-                            'y_coords': y_coords,
-                            'crs_wkt': crs_wkt,
-                            'shape': shape,
-                            'complevel': self.netcdf_complevel,
-                        })
-                    
-                    # Process Chunks in Parallel
-                    with mp.Pool(n_workers) as pool:
-                        results = pool.map(process_netcdf_chunk, chunks)
-                    
-                    for r in results:
-                        if r.startswith('✗'):
-                            logger.error(f"  {r}")
-                        else:
-                            logger.info(f"  {r}")
-                    
-                    # Merge if necessary
-                    if total_chunks > 1:
-                        # Reconstruct expected chunk filenames
-                        expected_chunks = []
-                        for i in range(1, total_chunks + 1):
-                            expected_chunks.append(self.output_folder / f"{tile_id}_{vi_type}_chunk{i:02d}.nc")
-                        
-                        self.merge_chunks(tile_id, vi_type, expected_chunks)
-                        
+                    grid = self.tile_grid(tile_id, file_org[tile_id][vi_type][0]['file_path'])
+                    break
                 except Exception as e:
-                    logger.error(f"Error preparing tile {tile_id}: {e}")
+                    grid_err = e
+            if grid is None:
+                logger.error(f"Error preparing tile {tile_id}: {grid_err}")
+                continue
+            x_coords, y_coords, crs_wkt, shape = grid
+
+            # Coordinates go to the workers through shared memory, once per
+            # tile, instead of being pickled into every task.
+            x_shm, x_spec = share_array(x_coords)
+            y_shm, y_spec = share_array(y_coords)
+            try:
+                for vi_type in vi_types:
+                    files = file_org[tile_id][vi_type]
+                    logger.info(f"  {vi_type}: {len(files)} granules")
+                    self._build_vi(tile_id, vi_type, files, chunk_size, n_workers,
+                                   x_spec, y_spec, crs_wkt, shape)
+            finally:
+                for shm in (x_shm, y_shm):
+                    shm.close()
+                    shm.unlink()
+
+    def _build_vi(self, tile_id, vi_type, files, chunk_size, n_workers,
+                  x_spec, y_spec, crs_wkt, shape):
+        try:
+            # Create Chunks
+            chunks = []
+            total_chunks = (len(files) + chunk_size - 1) // chunk_size
+            
+            for i, start_idx in enumerate(range(0, len(files), chunk_size)):
+                chunk_files = files[start_idx : start_idx + chunk_size]
+                chunks.append({
+                    'chunk_id': i + 1,
+                    'total_chunks': total_chunks,
+                    'files': chunk_files,
+                    'tile_id': tile_id,
+                    'vi_type': vi_type,
+                    'output_folder': str(self.output_folder),
+                    'x_coords': x_spec,
+                    'y_coords': y_spec,
+                    'crs_wkt': crs_wkt,
+                    'shape': shape,
+                    'complevel': self.netcdf_complevel,
+                    'compression': self.netcdf_compression,
+                    'n_workers': n_workers,
+                })
+            
+            # Process Chunks in Parallel
+            with mp.Pool(n_workers) as pool:
+                results = pool.map(process_netcdf_chunk, chunks)
+            
+            for r in results:
+                if r.startswith('✗'):
+                    logger.error(f"  {r}")
+                else:
+                    logger.info(f"  {r}")
+            
+            # Merge if necessary
+            if total_chunks > 1:
+                # Reconstruct expected chunk filenames
+                expected_chunks = []
+                for i in range(1, total_chunks + 1):
+                    expected_chunks.append(self.output_folder / f"{tile_id}_{vi_type}_chunk{i:02d}.nc")
+                
+                self.merge_chunks(tile_id, vi_type, expected_chunks)
+                
+        except Exception as e:
+            logger.error(f"Error preparing tile {tile_id}: {e}")
 
 if __name__ == "__main__":
     # --- CONFIGURATION FROM ENV ---
@@ -411,7 +532,8 @@ if __name__ == "__main__":
 
     logger.info("Step 03: NetCDF Aggregation")
     logger.info(f"  VIs          : {processed_vis}")
-    logger.info(f"  Workers      : {n_workers}  |  Chunk size: {chunk_size}  |  complevel: {netcdf_complevel}")
+    logger.info(f"  Workers      : {n_workers}  |  Chunk size: {chunk_size}  |  "
+                f"compression: {os.environ.get('NETCDF_COMPRESSION', 'zlib').lower()} (level {netcdf_complevel})")
     logger.info(f"  Input dir    : {input_folder}")
     logger.info(f"  Output dir   : {netcdf_output_folder}")
 
@@ -7,22 +7,25 @@
 #
 # Reads PROCESSED_VIS from env and processes ALL listed VIs in one run.
 # Files are processed in parallel across tiles using ProcessPoolExecutor.
-# Uses dask.config.set(scheduler='synchronous') inside each worker to prevent
-# nested thread pools competing for CPU cores.
+# NetCDF files are read directly with netCDF4 (no xarray/dask), one on-disk
+# chunk row at a time.
 #
 # Author:  Stephen Conklin <stephenconklin@gmail.com>
 #          https://github.com/stephenconklin
 # License: MIT
 
-import xarray as xr
-import rioxarray          # noqa: F401 — activates .rio accessor
+import netCDF4 as nc4
 import rasterio
 import os
-import glob
+from collections import defaultdict
+from datetime import datetime
 import warnings
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from hls_utils import filter_by_configured_tiles, get_valid_range, detect_crs, reproject_resolution, setup_logging
+from concurrent.futures import ProcessPoolExecutor
+from hls_kernels import range_sum_accumulate, set_worker_threads
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       get_valid_range, detect_nc_crs, group_by_vi, imap_bounded, iter_chunk_rows,
+                       reproject_array, reproject_resolution, setup_logging, transform_from_coords)
 
 logger = setup_logging("04_mean_reproject")
 
@@ -30,12 +33,12 @@ warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarni
 
 # --- CONFIGURATION FROM ENV ---
 INPUT_FOLDER  = os.environ.get("NETCDF_DIR",      "")
+VI_FOLDER     = os.environ.get("VI_OUTPUT_DIR",   "")
 OUTPUT_FOLDER = os.environ.get("REPROJECTED_DIR", "")
 TARGET_CRS        = os.environ.get("TARGET_CRS",         "EPSG:6350")
 PROCESSED_VIS     = os.environ.get("PROCESSED_VIS",     "NDVI EVI2 NIRv").split()
 N_WORKERS         = int(os.environ.get("NUM_WORKERS",    4))
-GEOTIFF_COMPRESS  = os.environ.get("GEOTIFF_COMPRESS",  "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE", 512))
+MEAN_FROM_VI_TIFS = os.environ.get("MEAN_FROM_VI_TIFS", "TRUE").upper() == "TRUE"
 
 if not INPUT_FOLDER or not OUTPUT_FOLDER:
     raise ValueError("NETCDF_DIR or REPROJECTED_DIR not set.")
@@ -43,13 +46,116 @@ if not INPUT_FOLDER or not OUTPUT_FOLDER:
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 
+def _index_vi_tifs():
+    """Map (tile, vi_type) → step-02 VI GeoTIFF paths, from one walk of VI_OUTPUT_DIR.
+
+    Names follow HLS.<sensor>.<tile>.<datetime>.<version>.<VI>.tif, e.g.
+    HLS.L30.T18TVL.2020001T154931.v2.0.NDVI.tif → ('T18TVL', 'NDVI').
+    """
+    index = defaultdict(list)
+    for path in find_files(VI_FOLDER, ".tif"):
+        parts = os.path.basename(path).split('.')
+        if len(parts) >= 5 and parts[0] == 'HLS':
+            index[(parts[2], parts[-2])].append(path)
+    return index
+
+
+def _tif_day(path):
+    """Acquisition date of a step-02 VI GeoTIFF, in days since 1970-01-01.
+
+    Parsed from the <datetime> name field (YYYYDDD…) as step 03 does, so it
+    matches the NetCDF 'time' values. Raises ValueError on a malformed name.
+    """
+    day = datetime.strptime(os.path.basename(path).split('.')[3][:7], "%Y%j")
+    return (day - datetime(1970, 1, 1)).days
+
+
+def _find_vi_tifs(tifs, times, shape):
+    """Return the usable step-02 VI GeoTIFFs behind one NetCDF file, or None.
+
+    The GeoTIFFs are only used when they are exactly the granules step 03
+    aggregated: their acquisition dates must match the NetCDF *times* (days
+    since 1970-01-01) one for one. Granules whose shape differs from the
+    tile grid are dropped, as step 03 stores them as all-NaN slices. None
+    (use the NetCDF) if the dates differ or any file cannot be opened.
+    """
+    if not tifs or len(tifs) != len(times):
+        return None
+    try:
+        if sorted(map(_tif_day, tifs)) != sorted(int(t) for t in times):
+            return None
+    except (IndexError, ValueError):
+        return None
+    usable = []
+    try:
+        with gdal_env(N_WORKERS):
+            for tif in tifs:
+                with rasterio.open(tif) as src:
+                    if src.shape == shape:
+                        usable.append(tif)
+    except rasterio.errors.RasterioError:
+        return None
+    return usable
+
+
+def _accumulate(total, count, block, vmin, vmax):
+    """Add the in-range values of *block* ((rows, cols) or (t, rows, cols)) into total/count.
+
+    Masking and summing happen in one Numba pass; NaN and fill values
+    compare False and are skipped.
+    """
+    if block.ndim == 2:
+        block = block[np.newaxis]
+    range_sum_accumulate(block, vmin, vmax, total, count)
+
+
+def _finish_mean(total, count):
+    """Return total / count as float32, NaN where no value was valid."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / count).astype(np.float32)
+
+
+def _mean_from_tifs(tifs, shape, vmin, vmax):
+    """Per-pixel mean of the in-range values across *tifs*, streamed by block.
+
+    Only a running sum and count of size (Y, X) are held in memory, rather
+    than the (T, Y, X) cube. Pixels with no valid value are NaN.
+    """
+    total = np.zeros(shape, dtype=np.float64)
+    count = np.zeros(shape, dtype=np.uint32)
+    with gdal_env(N_WORKERS):
+        for tif in tifs:
+            with rasterio.open(tif) as src:
+                for _, win in src.block_windows(1):
+                    sl = win.toslices()
+                    _accumulate(total[sl], count[sl], src.read(1, window=win), vmin, vmax)
+    return _finish_mean(total, count)
+
+
+def _mean_from_netcdf(var, vmin, vmax):
+    """Per-pixel mean of the in-range values of a (time, y, x) netCDF4 variable.
+
+    Reads one on-disk chunk row at a time (a time group × row band) straight
+    into numpy and folds it into a running sum/count, so the range mask and
+    the reduction are a single pass and no masked (T, Y, X) copy is ever
+    allocated.
+    """
+    _, n_y, n_x = var.shape
+    total = np.zeros((n_y, n_x), dtype=np.float64)
+    count = np.zeros((n_y, n_x), dtype=np.uint32)
+    for y0, block in iter_chunk_rows(var):
+        rows = slice(y0, y0 + block.shape[1])
+        _accumulate(total[rows], count[rows], block, vmin, vmax)
+    return _finish_mean(total, count)
+
+
 def process_file(args):
     """
     Worker: compute temporal mean for one (nc_path, vi_type) pair,
-    reproject to TARGET_CRS, and write a GeoTIFF.
+    reproject to TARGET_CRS, and write a GeoTIFF. The third item is the
+    tile's step-02 GeoTIFF list for the fast path (None to read the NetCDF).
     """
-    import dask
-    nc_path, vi_type = args
+    nc_path, vi_type, vi_tifs = args
     try:
         filename    = os.path.basename(nc_path)
         safe_crs    = TARGET_CRS.replace(':', '')
@@ -59,40 +165,68 @@ def process_file(args):
         if os.path.exists(output_path):
             return f"Skipped (Exists): {vi_type} / {filename}"
 
-        ds = xr.open_dataset(nc_path, chunks='auto')
-
-        if vi_type in ds.data_vars:
-            da = ds[vi_type]
-        else:
-            candidates = [v for v in ds.data_vars if vi_type.lower() in v.lower()]
-            if not candidates:
-                ds.close()
-                return f"Error: {vi_type} not found in {filename}"
-            da = ds[candidates[0]]
-
-        source_crs = detect_crs(ds, da)
-        if source_crs is None:
-            ds.close()
-            return f"WARNING: No CRS in {filename}. Skipping."
-
-        vmin, vmax = get_valid_range(vi_type)
-        valid_data = da.where((da >= vmin) & (da <= vmax))
-
-        # dask.config.set replaces xr.set_options(scheduler=...) which was
-        # removed in xarray 2024.x. Forces synchronous execution inside each
-        # worker process to prevent nested thread pools competing for cores.
-        with dask.config.set(scheduler='synchronous'):
-            mean_val = valid_data.mean(dim='time', skipna=True, keep_attrs=True).compute()
-
-        mean_val.rio.write_crs(source_crs, inplace=True)
-        reprojected = mean_val.rio.reproject(TARGET_CRS, resolution=reproject_resolution(TARGET_CRS), nodata=np.nan)
-        reprojected.rio.to_raster(
-            output_path, compress=GEOTIFF_COMPRESS, tiled=True,
-            blockxsize=GEOTIFF_BLOCK_SIZE, blockysize=GEOTIFF_BLOCK_SIZE,
-            dtype='float32', nodata=np.nan
-        )
-        ds.close()
-        return f"OK: {vi_type} / {filename}"
+        set_worker_threads(N_WORKERS)
+
+        with nc4.Dataset(nc_path, 'r') as ds:
+            data_vars = [v for v in ds.variables if v not in ds.dimensions]
+            if vi_type in data_vars:
+                var = ds.variables[vi_type]
+            else:
+                candidates = [v for v in data_vars if vi_type.lower() in v.lower()]
+                if not candidates:
+                    return f"Error: {vi_type} not found in {filename}"
+                var = ds.variables[candidates[0]]
+
+            source_crs = detect_nc_crs(ds, var)
+            if source_crs is None:
+                return f"WARNING: No CRS in {filename}. Skipping."
+
+            vmin, vmax = get_valid_range(vi_type)
+            band_name = var.name
+            src_transform = transform_from_coords(ds.variables['x'][:], ds.variables['y'][:])
+
+            # Fast path: stream the step-02 GeoTIFFs block by block. The NetCDF
+            # still supplies the grid coordinates and CRS (including the
+            # southern-hemisphere remap done in step 03). GeoTIFFs whose dates
+            # do not match the NetCDF time axis, or any GeoTIFF that cannot be
+            # read, send the whole tile to the NetCDF instead.
+            _, n_y, n_x = var.shape
+            tifs = _find_vi_tifs(vi_tifs, ds.variables['time'][:], (n_y, n_x))
+            mean_arr, source = None, "netcdf"
+            if tifs is not None:
+                try:
+                    mean_arr, source = _mean_from_tifs(tifs, (n_y, n_x), vmin, vmax), "tif"
+                except rasterio.errors.RasterioError:
+                    mean_arr = None
+            if mean_arr is None:
+                mean_arr = _mean_from_netcdf(var, vmin, vmax)
+
+        # Reproject the plain (Y, X) array straight into a preallocated
+        # destination buffer.
+        with gdal_env(N_WORKERS):
+            dst_arr, dst_transform = reproject_array(
+                mean_arr, src_transform, source_crs, TARGET_CRS,
+                reproject_resolution(TARGET_CRS), nodata=np.nan,
+            )
+            # GDAL's COG driver: tiled, with internal overviews (nodata-aware
+            # averaging) laid out per the Cloud-Optimized GeoTIFF spec. The
+            # shared GTiff options are translated to the COG driver's names.
+            gtiff = geotiff_options('float32')
+            profile = dict(
+                driver='COG', dtype='float32', count=1, nodata=np.nan,
+                width=dst_arr.shape[1], height=dst_arr.shape[0],
+                crs=TARGET_CRS, transform=dst_transform,
+                compress=gtiff['compress'], blocksize=gtiff['blockxsize'],
+                overview_resampling='AVERAGE', bigtiff='IF_SAFER',
+            )
+            if 'predictor' in gtiff:
+                profile['predictor'] = 'FLOATING_POINT'
+            if 'zstd_level' in gtiff:
+                profile['level'] = gtiff['zstd_level']
+            with rasterio.open(output_path, 'w', **profile) as dst:
+                dst.write(dst_arr, 1)
+                dst.set_band_description(1, band_name)
+        return f"OK: {vi_type} / {filename} ({source})"
 
     except Exception as e:
         return f"Error ({vi_type} / {os.path.basename(nc_path)}): {e}"
@@ -107,20 +241,21 @@ def main():
         vmin, vmax = get_valid_range(vi)
         logger.info(f"  Valid range  {vi}: [{vmin}, {vmax}]")
 
-    all_nc_files = glob.glob(os.path.join(INPUT_FOLDER, "**", "*.nc"), recursive=True)
+    all_nc_files = list(find_files(INPUT_FOLDER, ".nc"))
     all_nc_files = filter_by_configured_tiles(all_nc_files)
     if not all_nc_files:
         logger.error(f"No NetCDF files found in: {INPUT_FOLDER}")
         return
 
-    # Build (nc_path, vi_type) work items — match each file to its VI by name
-    work_items = []
-    for nc_path in all_nc_files:
-        fname = os.path.basename(nc_path)
-        for vi in PROCESSED_VIS:
-            if vi in fname:
-                work_items.append((nc_path, vi))
-                break
+    # Step-02 GeoTIFFs per (tile, VI), indexed with one directory walk
+    vi_tifs = _index_vi_tifs() if MEAN_FROM_VI_TIFS and VI_FOLDER else {}
+
+    # Build (nc_path, vi_type, tifs) work items — match each file to its VI by name
+    by_vi      = group_by_vi(all_nc_files, PROCESSED_VIS)
+    work_items = [
+        (nc_path, vi, vi_tifs.get((os.path.basename(nc_path).split('_')[0], vi)))
+        for vi, paths in by_vi.items() for nc_path in paths
+    ]
 
     logger.info(f"Found {len(all_nc_files)} NetCDF file(s) → {len(work_items)} work item(s).")
 
@@ -129,12 +264,12 @@ def main():
         return
 
     completed, total = 0, len(work_items)
+    n_source = {"tif": 0, "netcdf": 0}
     with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-        futures = {executor.submit(process_file, item): item for item in work_items}
-        for future in as_completed(futures):
+        for result in imap_bounded(executor, process_file, work_items, 2 * N_WORKERS):
             completed += 1
-            result = future.result()
             if result.startswith("OK"):
+                n_source[result.rsplit("(", 1)[-1].rstrip(")")] += 1
                 if completed % 5 == 0 or completed == total:
                     logger.info(f"  [{completed}/{total}] {result}")
             elif result.startswith("Skipped"):
@@ -144,7 +279,8 @@ def main():
             else:
                 logger.error(f"  [{completed}/{total}] {result}")
 
-    logger.info(f"Step 04 complete. Processed {total} work item(s).")
+    logger.info(f"Step 04 complete. Processed {total} work item(s) "
+                f"(means from VI GeoTIFFs: {n_source['tif']}, from NetCDF: {n_source['netcdf']}).")
 
 
 if __name__ == "__main__":
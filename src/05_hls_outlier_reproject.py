@@ -6,26 +6,33 @@
 #   for each VI. Compute temporal mean + count, reproject, write GeoTIFFs.
 #
 # Reads PROCESSED_VIS from env and processes ALL listed VIs in one run.
-# Produces two output GeoTIFFs per tile per VI:
+# Produces three output GeoTIFFs per tile per VI:
 #   *_outlier_mean_{VI}_{CRS}.tif   — float32, temporal mean of outlier values
 #   *_outlier_count_{VI}_{CRS}.tif  — uint16, count of outlier observations
+#   *_count_valid_{VI}_{CRS}.tif    — uint16, count of in-range observations
+#                                     (reused by step 09 instead of re-reading
+#                                     the NetCDF)
 #
-# Uses dask.config.set(scheduler='synchronous') inside each worker to prevent
-# nested thread pools competing for CPU cores.
+# NetCDF files are read directly with netCDF4, one on-disk chunk row at a
+# time, and reduced by a fused Numba kernel (hls_kernels.fused_stats_accumulate)
+# that computes the outlier sum/count and the valid count in a single pass.
+# Numba threads are capped at cpu_count // NUM_WORKERS per worker process.
 #
 # Author:  Stephen Conklin <stephenconklin@gmail.com>
 #          https://github.com/stephenconklin
 # License: MIT
 
-import xarray as xr
-import rioxarray          # noqa: F401 — activates .rio accessor
+import netCDF4 as nc4
 import rasterio
 import os
-import glob
 import warnings
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from hls_utils import filter_by_configured_tiles, get_valid_range, detect_crs, reproject_resolution, setup_logging
+from concurrent.futures import ProcessPoolExecutor
+from hls_kernels import fused_stats_accumulate, set_worker_threads, to_uint16
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       get_valid_range, detect_nc_crs, group_by_vi, imap_bounded, iter_chunk_rows,
+                       reproject_array, reproject_resolution, setup_logging, transform_from_coords,
+                       worker_threads)
 
 logger = setup_logging("05_outlier_reproject")
 
@@ -37,8 +44,6 @@ OUTPUT_FOLDER = os.environ.get("REPROJECTED_DIR_OUTLIERS", "")
 TARGET_CRS         = os.environ.get("TARGET_CRS",               "EPSG:6350")
 PROCESSED_VIS      = os.environ.get("PROCESSED_VIS",           "NDVI EVI2 NIRv").split()
 N_WORKERS          = int(os.environ.get("NUM_WORKERS",          4))
-GEOTIFF_COMPRESS   = os.environ.get("GEOTIFF_COMPRESS",        "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE",  512))
 
 if not INPUT_FOLDER or not OUTPUT_FOLDER:
     raise ValueError("NETCDF_DIR or REPROJECTED_DIR_OUTLIERS not set.")
@@ -46,12 +51,24 @@ if not INPUT_FOLDER or not OUTPUT_FOLDER:
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 
+def _write_tif(path, arr, transform, dtype, nodata, band_name):
+    """Write a single-band tiled GeoTIFF in TARGET_CRS."""
+    profile = dict(
+        driver='GTiff', dtype=dtype, count=1, nodata=nodata,
+        width=arr.shape[1], height=arr.shape[0],
+        crs=TARGET_CRS, transform=transform, **geotiff_options(dtype),
+    )
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr.astype(dtype, copy=False), 1)
+        dst.set_band_description(1, band_name)
+
+
 def process_file(args):
     """
     Worker: extract outlier pixels for one (nc_path, vi_type) pair,
-    compute temporal mean + count, reproject, write two GeoTIFFs.
+    compute temporal mean + count and the valid count, reproject, write
+    three GeoTIFFs.
     """
-    import dask
     nc_path, vi_type = args
     try:
         filename = os.path.basename(nc_path)
@@ -61,68 +78,75 @@ def process_file(args):
                         filename.replace(".nc", f"_outlier_mean_{vi_type}_{safe_crs}.tif"))
         count_path = os.path.join(OUTPUT_FOLDER,
                         filename.replace(".nc", f"_outlier_count_{vi_type}_{safe_crs}.tif"))
+        valid_path = os.path.join(OUTPUT_FOLDER,
+                        filename.replace(".nc", f"_count_valid_{vi_type}_{safe_crs}.tif"))
 
-        if os.path.exists(mean_path) and os.path.exists(count_path):
+        if all(os.path.exists(p) for p in (mean_path, count_path, valid_path)):
             return f"Skipped (Exists): {vi_type} / {filename}"
 
-        ds = xr.open_dataset(nc_path, chunks='auto')
-
-        if vi_type in ds.data_vars:
-            da = ds[vi_type]
-        else:
-            candidates = [v for v in ds.data_vars if vi_type.lower() in v.lower()]
-            if not candidates:
-                ds.close()
-                return f"Error: {vi_type} not found in {filename}"
-            da = ds[candidates[0]]
-
-        source_crs = detect_crs(ds, da)
-        if source_crs is None:
-            ds.close()
-            return f"WARNING: No CRS in {filename}. Skipping."
-
-        # Remove NetCDF fill values before testing for outlier range
-        clean_da = da.where(da < 1e30)
-
-        # Pixels outside the VI-specific valid range are outliers.
-        # Bounds are read from VALID_RANGE_{VI} in config.env.
-        vmin, vmax   = get_valid_range(vi_type)
-        outlier_data = clean_da.where((clean_da < vmin) | (clean_da > vmax))
-
-        # dask.config.set replaces xr.set_options(scheduler=...) which was
-        # removed in xarray 2024.x.
-        with dask.config.set(scheduler='synchronous'):
-            n_outliers = outlier_data.count().compute().item()
-
-        if n_outliers == 0:
-            ds.close()
-            return f"Skipped (No outliers): {vi_type} / {filename}"
-
-        # --- Outlier mean ---
-        with dask.config.set(scheduler='synchronous'):
-            outlier_mean = outlier_data.mean(dim='time', skipna=True).compute()
-
-        outlier_mean.rio.write_crs(source_crs, inplace=True)
-        reproj_mean = outlier_mean.rio.reproject(TARGET_CRS, resolution=reproject_resolution(TARGET_CRS))
-        reproj_mean.encoding.clear()
-        reproj_mean.rio.to_raster(mean_path, compress=GEOTIFF_COMPRESS, tiled=True,
-                                   blockxsize=GEOTIFF_BLOCK_SIZE, blockysize=GEOTIFF_BLOCK_SIZE,
-                                   dtype='float32', nodata=np.nan)
-
-        # --- Outlier count ---
-        with dask.config.set(scheduler='synchronous'):
-            outlier_count = outlier_data.count(dim='time').compute()
-
-        outlier_count.rio.write_crs(source_crs, inplace=True)
-        reproj_count = outlier_count.rio.reproject(TARGET_CRS, resolution=reproject_resolution(TARGET_CRS))
-        reproj_count = reproj_count.fillna(0).astype('uint16')
-        reproj_count.rio.write_nodata(0, encoded=True, inplace=True)
-        reproj_count.encoding.clear()
-        reproj_count.rio.to_raster(count_path, compress=GEOTIFF_COMPRESS, tiled=True,
-                                    blockxsize=GEOTIFF_BLOCK_SIZE, blockysize=GEOTIFF_BLOCK_SIZE,
-                                    dtype='uint16')
-
-        ds.close()
+        set_worker_threads(N_WORKERS)
+
+        with nc4.Dataset(nc_path, 'r') as ds:
+            data_vars = [v for v in ds.variables if v not in ds.dimensions]
+            if vi_type in data_vars:
+                var = ds.variables[vi_type]
+            else:
+                candidates = [v for v in data_vars if vi_type.lower() in v.lower()]
+                if not candidates:
+                    return f"Error: {vi_type} not found in {filename}"
+                var = ds.variables[candidates[0]]
+
+            source_crs = detect_nc_crs(ds, var)
+            if source_crs is None:
+                return f"WARNING: No CRS in {filename}. Skipping."
+
+            band_name = var.name
+            src_transform = transform_from_coords(ds.variables['x'][:], ds.variables['y'][:])
+
+            # Pixels outside the VI-specific valid range are outliers; NetCDF
+            # fill values (>= 1e30) and NaN are excluded inside the kernel.
+            # Bounds are read from VALID_RANGE_{VI} in config.env.
+            vmin, vmax = get_valid_range(vi_type)
+            _, n_y, n_x = var.shape
+            total = np.zeros((n_y, n_x), dtype=np.float64)
+            count = np.zeros((n_y, n_x), dtype=np.uint32)
+            valid = np.zeros((n_y, n_x), dtype=np.uint32)
+            for y0, block in iter_chunk_rows(var):
+                rows = slice(y0, y0 + block.shape[1])
+                fused_stats_accumulate(block, vmin, vmax, total[rows], count[rows], valid[rows])
+
+        # Warp with this worker's share of the cores (GDAL's default is one thread)
+        resolution = reproject_resolution(TARGET_CRS)
+        warp_opts  = dict(num_threads=worker_threads(N_WORKERS), warp_mem_limit=512)
+        with gdal_env(N_WORKERS):
+            # --- Valid count (same layout as the step 09 per-tile count) ---
+            reproj_valid, dst_transform = reproject_array(
+                to_uint16(valid), src_transform, source_crs, TARGET_CRS, resolution,
+                nodata=0, **warp_opts,
+            )
+            _write_tif(valid_path, reproj_valid, dst_transform, 'uint16', 0, band_name)
+            dst_grid = (dst_transform, reproj_valid.shape)
+
+            if not count.any():
+                return f"Skipped (No outliers): {vi_type} / {filename}"
+
+            # --- Outlier mean ---
+            with np.errstate(invalid='ignore', divide='ignore'):
+                outlier_mean = np.where(count > 0, total / count, np.nan)
+            reproj_mean, _ = reproject_array(
+                outlier_mean, src_transform, source_crs, TARGET_CRS, resolution,
+                nodata=np.nan, dst_grid=dst_grid, **warp_opts,
+            )
+            _write_tif(mean_path, reproj_mean, dst_transform, 'float32', np.nan, band_name)
+
+            # --- Outlier count (0 outside the source footprint; no nodata tag,
+            # since 0 is also a genuine "no outliers" count) ---
+            reproj_count, _ = reproject_array(
+                to_uint16(count), src_transform, source_crs, TARGET_CRS, resolution,
+                nodata=0, dst_grid=dst_grid, **warp_opts,
+            )
+            _write_tif(count_path, reproj_count, dst_transform, 'uint16', None, band_name)
+
         return f"OK: {vi_type} / {filename}"
 
     except Exception as e:
@@ -138,20 +162,15 @@ def main():
         vmin, vmax = get_valid_range(vi)
         logger.info(f"  Outlier threshold  {vi}: < {vmin} or > {vmax}")
 
-    all_nc_files = glob.glob(os.path.join(INPUT_FOLDER, "**", "*.nc"), recursive=True)
+    all_nc_files = list(find_files(INPUT_FOLDER, ".nc"))
     all_nc_files = filter_by_configured_tiles(all_nc_files)
     if not all_nc_files:
         logger.error(f"No NetCDF files found in: {INPUT_FOLDER}")
         return
 
     # Build (nc_path, vi_type) work items — match each file to its VI by name
-    work_items = []
-    for nc_path in all_nc_files:
-        fname = os.path.basename(nc_path)
-        for vi in PROCESSED_VIS:
-            if vi in fname:
-                work_items.append((nc_path, vi))
-                break
+    by_vi      = group_by_vi(all_nc_files, PROCESSED_VIS)
+    work_items = [(nc_path, vi) for vi, paths in by_vi.items() for nc_path in paths]
 
     logger.info(f"Found {len(all_nc_files)} NetCDF file(s) → {len(work_items)} work item(s).")
 
@@ -161,10 +180,8 @@ def main():
 
     completed, total = 0, len(work_items)
     with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-        futures = {executor.submit(process_file, item): item for item in work_items}
-        for future in as_completed(futures):
+        for result in imap_bounded(executor, process_file, work_items, 2 * N_WORKERS):
             completed += 1
-            result = future.result()
             if result.startswith("OK"):
                 if completed % 5 == 0 or completed == total:
                     logger.info(f"  [{completed}/{total}] {result}")
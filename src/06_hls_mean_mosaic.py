@@ -5,21 +5,21 @@
 # Pipeline Step 06 (mean_mosaic): Mosaic per-tile mean VI GeoTIFFs into
 #   continent-wide rasters.
 #
-# Reads PROCESSED_VIS from env and mosaics ALL listed VIs in one run.
-# Uses streaming rasterio.merge() — tiles are processed one at a time into
-# the output buffer, keeping peak RAM flat regardless of tile count.
+# Reads PROCESSED_VIS from env and mosaics ALL listed VIs in one run, one
+# thread per VI (the mosaics are independent and I/O-bound).
+# Uses hls_utils.streaming_merge() — the mosaic is written one output block at
+# a time, keeping peak RAM flat regardless of tile count and mosaic extent.
 # Output filenames: HLS_Mosaic_{VI}_{safe_crs}.tif
 #
 # Author:  Stephen Conklin <stephenconklin@gmail.com>
 #          https://github.com/stephenconklin
 # License: MIT
 
-import rasterio
-from rasterio.merge import merge as rasterio_merge
 import os
-import glob
 import numpy as np
-from hls_utils import filter_by_configured_tiles, setup_logging
+from concurrent.futures import ThreadPoolExecutor
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       setup_logging, streaming_merge, worker_threads)
 
 logger = setup_logging("06_mean_mosaic")
 
@@ -28,8 +28,9 @@ INPUT_FOLDER  = os.environ.get("REPROJECTED_DIR", "")
 MOSAIC_DIR    = os.environ.get("MOSAIC_DIR",       "")
 TARGET_CRS    = os.environ.get("TARGET_CRS",       "EPSG:6350")
 PROCESSED_VIS      = os.environ.get("PROCESSED_VIS",      "NDVI EVI2 NIRv").split()
-GEOTIFF_COMPRESS   = os.environ.get("GEOTIFF_COMPRESS",   "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE", 512))
+
+# VIs are mosaicked concurrently; each gets an equal share of the cores
+VI_THREADS = worker_threads(len(PROCESSED_VIS))
 
 if not INPUT_FOLDER or not MOSAIC_DIR:
     raise ValueError("REPROJECTED_DIR or MOSAIC_DIR not set.")
@@ -40,8 +41,9 @@ os.makedirs(MOSAIC_DIR, exist_ok=True)
 def mosaic_vi(vi_type):
     """Find all mean tiles for vi_type, stream-merge, write one mosaic GeoTIFF."""
     safe_crs    = TARGET_CRS.replace(':', '')
-    pattern     = os.path.join(INPUT_FOLDER, "**", f"*_average_{vi_type}_{safe_crs}.tif")
-    tif_files   = glob.glob(pattern, recursive=True)
+    suffix      = f"_average_{vi_type}_{safe_crs}.tif"
+    pattern     = os.path.join(INPUT_FOLDER, "**", f"*{suffix}")
+    tif_files   = list(find_files(INPUT_FOLDER, suffix))
     tif_files   = filter_by_configured_tiles(tif_files)
     output_file = os.path.join(MOSAIC_DIR, f"HLS_Mosaic_{vi_type}_{safe_crs}.tif")
 
@@ -58,33 +60,14 @@ def mosaic_vi(vi_type):
     logger.info(f"[{vi_type}] Merging {len(tif_files)} tile(s) → "
                 f"{os.path.basename(output_file)}")
 
-    src_files = []
     try:
-        src_files = [rasterio.open(f) for f in tif_files]
-
-        # Streaming merge — peak RAM ≈ one tile + output mosaic,
-        # NOT all tiles simultaneously (avoids OOM on large tile sets).
-        mosaic, transform = rasterio_merge(src_files, nodata=np.nan)
-
-        profile = src_files[0].profile.copy()
-        profile.update(
-            driver     = 'GTiff',
-            height     = mosaic.shape[1],
-            width      = mosaic.shape[2],
-            count      = 1,
-            dtype      = 'float32',
-            crs        = src_files[0].crs,
-            transform  = transform,
-            nodata     = np.nan,
-            compress   = GEOTIFF_COMPRESS,
-            tiled      = True,
-            blockxsize = GEOTIFF_BLOCK_SIZE,
-            blockysize = GEOTIFF_BLOCK_SIZE,
-            predictor  = 3,    # float differencing — correct for float32 VI data
-        )
-
-        with rasterio.open(output_file, 'w', **profile) as dst:
-            dst.write(mosaic[0], 1)
+        # Block-wise merge straight to disk — peak RAM ≈ one output block per
+        # tile, NOT the whole mosaic (avoids OOM on continent-wide extents).
+        with gdal_env(GDAL_NUM_THREADS=str(VI_THREADS)):
+            streaming_merge(
+                tif_files, output_file, nodata=np.nan, dtype='float32',
+                num_threads=VI_THREADS, **geotiff_options('float32'),
+            )
 
         logger.info(f"[{vi_type}] Written: {os.path.basename(output_file)}")
 
@@ -92,18 +75,14 @@ def mosaic_vi(vi_type):
         logger.error(f"[{vi_type}] Error: {e}")
         raise
 
-    finally:
-        for src in src_files:
-            src.close()
-
 
 def main():
     logger.info(f"Step 06: Mean VI Mosaic  |  Target CRS: {TARGET_CRS}")
     logger.info(f"  VIs        : {PROCESSED_VIS}")
     logger.info(f"  Input dir  : {INPUT_FOLDER}")
     logger.info(f"  Output dir : {MOSAIC_DIR}")
-    for vi in PROCESSED_VIS:
-        mosaic_vi(vi)
+    with ThreadPoolExecutor(max_workers=max(1, len(PROCESSED_VIS))) as executor:
+        list(executor.map(mosaic_vi, PROCESSED_VIS))
     logger.info("Step 06 complete.")
 
 
@@ -5,20 +5,21 @@
 # Pipeline Step 07 (outlier_mosaic): Mosaic per-tile outlier MEAN GeoTIFFs
 #   into continent-wide rasters.
 #
-# Reads PROCESSED_VIS from env and mosaics ALL listed VIs in one run.
-# Uses streaming rasterio.merge() to avoid loading all tiles into RAM.
+# Reads PROCESSED_VIS from env and mosaics ALL listed VIs in one run, one
+# thread per VI (the mosaics are independent and I/O-bound).
+# Uses hls_utils.streaming_merge() — written one output block at a time, so
+# neither the tiles nor the mosaic are ever held in RAM whole.
 # Output filenames: HLS_Mosaic_Outlier_Mean_{VI}_{safe_crs}.tif
 #
 # Author:  Stephen Conklin <stephenconklin@gmail.com>
 #          https://github.com/stephenconklin
 # License: MIT
 
-import rasterio
-from rasterio.merge import merge as rasterio_merge
 import os
-import glob
 import numpy as np
-from hls_utils import filter_by_configured_tiles, setup_logging
+from concurrent.futures import ThreadPoolExecutor
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       setup_logging, streaming_merge, worker_threads)
 
 logger = setup_logging("07_outlier_mean_mosaic")
 
@@ -27,8 +28,9 @@ INPUT_FOLDER  = os.environ.get("REPROJECTED_DIR_OUTLIERS", "")
 MOSAIC_DIR    = os.environ.get("MOSAIC_DIR",               "")
 TARGET_CRS    = os.environ.get("TARGET_CRS",               "EPSG:6350")
 PROCESSED_VIS      = os.environ.get("PROCESSED_VIS",           "NDVI EVI2 NIRv").split()
-GEOTIFF_COMPRESS   = os.environ.get("GEOTIFF_COMPRESS",        "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE",  512))
+
+# VIs are mosaicked concurrently; each gets an equal share of the cores
+VI_THREADS = worker_threads(len(PROCESSED_VIS))
 
 if not INPUT_FOLDER or not MOSAIC_DIR:
     raise ValueError("REPROJECTED_DIR_OUTLIERS or MOSAIC_DIR not set.")
@@ -39,9 +41,9 @@ os.makedirs(MOSAIC_DIR, exist_ok=True)
 def mosaic_outlier_mean(vi_type):
     """Find all outlier mean tiles for vi_type, stream-merge, write mosaic."""
     safe_crs    = TARGET_CRS.replace(':', '')
-    pattern     = os.path.join(INPUT_FOLDER, "**",
-                               f"*_outlier_mean_{vi_type}_{safe_crs}.tif")
-    tif_files   = glob.glob(pattern, recursive=True)
+    suffix      = f"_outlier_mean_{vi_type}_{safe_crs}.tif"
+    pattern     = os.path.join(INPUT_FOLDER, "**", f"*{suffix}")
+    tif_files   = list(find_files(INPUT_FOLDER, suffix))
     tif_files   = filter_by_configured_tiles(tif_files)
     output_file = os.path.join(MOSAIC_DIR,
                                f"HLS_Mosaic_Outlier_Mean_{vi_type}_{safe_crs}.tif")
@@ -59,30 +61,12 @@ def mosaic_outlier_mean(vi_type):
     logger.info(f"[{vi_type}] Merging {len(tif_files)} tile(s) → "
                 f"{os.path.basename(output_file)}")
 
-    src_files = []
     try:
-        src_files = [rasterio.open(f) for f in tif_files]
-        mosaic, transform = rasterio_merge(src_files, nodata=np.nan)
-
-        profile = src_files[0].profile.copy()
-        profile.update(
-            driver     = 'GTiff',
-            height     = mosaic.shape[1],
-            width      = mosaic.shape[2],
-            count      = 1,
-            dtype      = 'float32',
-            crs        = src_files[0].crs,
-            transform  = transform,
-            nodata     = np.nan,
-            compress   = GEOTIFF_COMPRESS,
-            tiled      = True,
-            blockxsize = GEOTIFF_BLOCK_SIZE,
-            blockysize = GEOTIFF_BLOCK_SIZE,
-            predictor  = 3,    # float differencing — correct for float32 VI data
-        )
-
-        with rasterio.open(output_file, 'w', **profile) as dst:
-            dst.write(mosaic[0], 1)
+        with gdal_env(GDAL_NUM_THREADS=str(VI_THREADS)):
+            streaming_merge(
+                tif_files, output_file, nodata=np.nan, dtype='float32',
+                num_threads=VI_THREADS, **geotiff_options('float32'),
+            )
 
         logger.info(f"[{vi_type}] Written: {os.path.basename(output_file)}")
 
@@ -90,18 +74,14 @@ def mosaic_outlier_mean(vi_type):
         logger.error(f"[{vi_type}] Error: {e}")
         raise
 
-    finally:
-        for src in src_files:
-            src.close()
-
 
 def main():
     logger.info(f"Step 07: Outlier Mean Mosaic  |  Target CRS: {TARGET_CRS}")
     logger.info(f"  VIs        : {PROCESSED_VIS}")
     logger.info(f"  Input dir  : {INPUT_FOLDER}")
     logger.info(f"  Output dir : {MOSAIC_DIR}")
-    for vi in PROCESSED_VIS:
-        mosaic_outlier_mean(vi)
+    with ThreadPoolExecutor(max_workers=max(1, len(PROCESSED_VIS))) as executor:
+        list(executor.map(mosaic_outlier_mean, PROCESSED_VIS))
     logger.info("Step 07 complete.")
 
 
@@ -5,8 +5,10 @@
 # Pipeline Step 08 (outlier_counts): Mosaic per-tile outlier COUNT GeoTIFFs
 #   into continent-wide rasters.
 #
-# Reads PROCESSED_VIS from env and mosaics ALL listed VIs in one run.
-# Uses streaming rasterio.merge() to avoid loading all tiles into RAM.
+# Reads PROCESSED_VIS from env and mosaics ALL listed VIs in one run, one
+# thread per VI (the mosaics are independent and I/O-bound).
+# Uses hls_utils.streaming_merge() — written one output block at a time, so
+# neither the tiles nor the mosaic are ever held in RAM whole.
 # dtype=uint16, nodata=0 (zero means "no outliers", not missing data).
 # Output filenames: HLS_Mosaic_Outlier_Count_{VI}_{safe_crs}.tif
 #
@@ -14,12 +16,10 @@
 #          https://github.com/stephenconklin
 # License: MIT
 
-import rasterio
-from rasterio.merge import merge as rasterio_merge
 import os
-import glob
-import numpy as np
-from hls_utils import filter_by_configured_tiles, setup_logging
+from concurrent.futures import ThreadPoolExecutor
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       setup_logging, streaming_merge, worker_threads)
 
 logger = setup_logging("08_outlier_count_mosaic")
 
@@ -28,8 +28,9 @@ INPUT_FOLDER  = os.environ.get("REPROJECTED_DIR_OUTLIERS", "")
 MOSAIC_DIR    = os.environ.get("MOSAIC_DIR",               "")
 TARGET_CRS    = os.environ.get("TARGET_CRS",               "EPSG:6350")
 PROCESSED_VIS      = os.environ.get("PROCESSED_VIS",           "NDVI EVI2 NIRv").split()
-GEOTIFF_COMPRESS   = os.environ.get("GEOTIFF_COMPRESS",        "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE",  512))
+
+# VIs are mosaicked concurrently; each gets an equal share of the cores
+VI_THREADS = worker_threads(len(PROCESSED_VIS))
 
 if not INPUT_FOLDER or not MOSAIC_DIR:
     raise ValueError("REPROJECTED_DIR_OUTLIERS or MOSAIC_DIR not set.")
@@ -40,9 +41,9 @@ os.makedirs(MOSAIC_DIR, exist_ok=True)
 def mosaic_outlier_count(vi_type):
     """Find all outlier count tiles for vi_type, stream-merge, write mosaic."""
     safe_crs    = TARGET_CRS.replace(':', '')
-    pattern     = os.path.join(INPUT_FOLDER, "**",
-                               f"*_outlier_count_{vi_type}_{safe_crs}.tif")
-    tif_files   = glob.glob(pattern, recursive=True)
+    suffix      = f"_outlier_count_{vi_type}_{safe_crs}.tif"
+    pattern     = os.path.join(INPUT_FOLDER, "**", f"*{suffix}")
+    tif_files   = list(find_files(INPUT_FOLDER, suffix))
     tif_files   = filter_by_configured_tiles(tif_files)
     output_file = os.path.join(MOSAIC_DIR,
                                f"HLS_Mosaic_Outlier_Count_{vi_type}_{safe_crs}.tif")
@@ -60,32 +61,13 @@ def mosaic_outlier_count(vi_type):
     logger.info(f"[{vi_type}] Merging {len(tif_files)} tile(s) → "
                 f"{os.path.basename(output_file)}")
 
-    src_files = []
     try:
-        src_files = [rasterio.open(f) for f in tif_files]
-
         # nodata=0: zero count is semantically "no outliers", not a gap.
-        mosaic, transform = rasterio_merge(src_files, nodata=0)
-
-        profile = src_files[0].profile.copy()
-        profile.update(
-            driver     = 'GTiff',
-            height     = mosaic.shape[1],
-            width      = mosaic.shape[2],
-            count      = 1,
-            dtype      = 'uint16',
-            crs        = src_files[0].crs,
-            transform  = transform,
-            nodata     = 0,
-            compress   = GEOTIFF_COMPRESS,
-            tiled      = True,
-            blockxsize = GEOTIFF_BLOCK_SIZE,
-            blockysize = GEOTIFF_BLOCK_SIZE,
-            predictor  = 2,    # integer differencing — correct for uint16 count data
-        )
-
-        with rasterio.open(output_file, 'w', **profile) as dst:
-            dst.write(mosaic[0].astype('uint16'), 1)
+        with gdal_env(GDAL_NUM_THREADS=str(VI_THREADS)):
+            streaming_merge(
+                tif_files, output_file, nodata=0, dtype='uint16',
+                num_threads=VI_THREADS, **geotiff_options('uint16'),
+            )
 
         logger.info(f"[{vi_type}] Written: {os.path.basename(output_file)}")
 
@@ -93,18 +75,14 @@ def mosaic_outlier_count(vi_type):
         logger.error(f"[{vi_type}] Error: {e}")
         raise
 
-    finally:
-        for src in src_files:
-            src.close()
-
 
 def main():
     logger.info(f"Step 08: Outlier Count Mosaic  |  Target CRS: {TARGET_CRS}")
     logger.info(f"  VIs        : {PROCESSED_VIS}")
     logger.info(f"  Input dir  : {INPUT_FOLDER}")
     logger.info(f"  Output dir : {MOSAIC_DIR}")
-    for vi in PROCESSED_VIS:
-        mosaic_outlier_count(vi)
+    with ThreadPoolExecutor(max_workers=max(1, len(PROCESSED_VIS))) as executor:
+        list(executor.map(mosaic_outlier_count, PROCESSED_VIS))
     logger.info("Step 08 complete.")
 
 
@@ -13,6 +13,13 @@
 #   4. Mosaics all tiles into a single-band uint16 GeoTIFF:
 #        HLS_Mosaic_CountValid_{VI}_{safe_crs}.tif
 #
+# Step 05 writes the same per-tile count (*_count_valid_{VI}_{CRS}.tif in
+# REPROJECTED_DIR_OUTLIERS) from its single NetCDF pass; when that tile exists
+# it is mosaicked directly and the NetCDF is not read again.
+#
+# The tiles of all VIs run through one worker pool; each VI is mosaicked as
+# soon as its last tile finishes.
+#
 # The temporal scope is implicitly defined by DOWNLOAD_CYCLES — since only
 # data within those cycles is present in the NetCDF files, no explicit date
 # filtering is required; all observations in the NetCDF are within scope.
@@ -25,16 +32,18 @@
 # License: MIT
 
 import os
-import glob
 import warnings
 import tempfile
+import threading
 import numpy as np
-import xarray as xr
-import rioxarray         # noqa: F401 — activates .rio accessor
+import netCDF4 as nc4
 import rasterio
-from rasterio.merge import merge as rasterio_merge
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from hls_utils import filter_by_configured_tiles, get_valid_range, detect_crs, reproject_resolution, setup_logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hls_kernels import set_worker_threads, to_uint16, valid_count_accumulate
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       get_valid_range, detect_nc_crs, group_by_vi, imap_bounded, iter_chunk_rows,
+                       reproject_array, reproject_resolution, setup_logging, streaming_merge,
+                       transform_from_coords, worker_threads)
 
 logger = setup_logging("09_count_valid")
 
@@ -45,11 +54,10 @@ warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarni
 # =============================================================================
 NETCDF_DIR    = os.environ.get("NETCDF_DIR",   "")
 MOSAIC_DIR    = os.environ.get("MOSAIC_DIR",   "")
+OUTLIER_DIR   = os.environ.get("REPROJECTED_DIR_OUTLIERS", "")
 TARGET_CRS    = os.environ.get("TARGET_CRS",   "EPSG:6350")
 PROCESSED_VIS      = os.environ.get("PROCESSED_VIS",      "NDVI EVI2 NIRv").split()
 N_WORKERS          = int(os.environ.get("NUM_WORKERS",     4))
-GEOTIFF_COMPRESS   = os.environ.get("GEOTIFF_COMPRESS",   "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE", 512))
 
 if not NETCDF_DIR or not MOSAIC_DIR:
     raise ValueError("NETCDF_DIR or MOSAIC_DIR not set in environment.")
@@ -64,9 +72,12 @@ os.makedirs(MOSAIC_DIR, exist_ok=True)
 def _process_tile(args: dict) -> dict:
     """
     Worker: open one tile's NetCDF, count valid observations across all time
-    steps, reproject to TARGET_CRS, write a temp GeoTIFF.
+    steps, reproject to TARGET_CRS, write a temp GeoTIFF. Returns the step 05
+    count tile instead when one exists for this tile/VI/CRS and is no older
+    than the NetCDF (step 05 skips existing outputs, so an older tile may
+    predate a step 03 rebuild or a VALID_RANGE change). Every result
+    carries 'vi_type' so the caller can route it to that VI's mosaic.
     """
-    import dask
 
     nc_path    = args['nc_path']
     vi_type    = args['vi_type']
@@ -77,73 +88,76 @@ def _process_tile(args: dict) -> dict:
     tile_id  = filename.split('_')[0] if '_' in filename else filename.replace('.nc', '')
 
     try:
-        ds = xr.open_dataset(nc_path, chunks='auto')
-
-        if vi_type in ds.data_vars:
-            da = ds[vi_type]
-        else:
-            candidates = [v for v in ds.data_vars if vi_type.lower() in v.lower()]
-            if not candidates:
-                ds.close()
-                return {'status': 'skip',
-                        'message': f"Variable {vi_type} not found in {filename}"}
-            da = ds[candidates[0]]
-
-        source_crs = detect_crs(ds, da)
-        if source_crs is None:
-            ds.close()
-            return {'status': 'skip', 'message': f"No CRS in {filename}"}
-
-        n_obs = int(ds['time'].size)
-        if n_obs == 0:
-            ds.close()
-            return {'status': 'skip', 'message': f"No time steps in {filename}"}
-
-        vmin, vmax = get_valid_range(vi_type)
-        valid = da.where((da >= vmin) & (da <= vmax))
-
-        # dask.config.set prevents nested thread pools inside worker processes.
-        with dask.config.set(scheduler='synchronous'):
-            count_valid = valid.count(dim='time').compute()
-
-        count_valid.rio.write_crs(source_crs, inplace=True)
-        reproj_count = count_valid.rio.reproject(target_crs, resolution=reproject_resolution(target_crs), nodata=0)
-        reproj_count = reproj_count.fillna(0).astype('uint16')
+        if OUTLIER_DIR:
+            safe_crs = target_crs.replace(':', '')
+            step05_tile = os.path.join(OUTLIER_DIR,
+                            filename.replace('.nc', f"_count_valid_{vi_type}_{safe_crs}.tif"))
+            if (os.path.exists(step05_tile)
+                    and os.path.getmtime(step05_tile) >= os.path.getmtime(nc_path)):
+                return {
+                    'status':     'ok',
+                    'vi_type':    vi_type,
+                    'count_path': step05_tile,
+                    'reused':     True,
+                    'message':    f"OK (step 05 tile): {tile_id}",
+                }
+
+        set_worker_threads(N_WORKERS)
+
+        with nc4.Dataset(nc_path, 'r') as ds:
+            data_vars = [v for v in ds.variables if v not in ds.dimensions]
+            if vi_type in data_vars:
+                var = ds.variables[vi_type]
+            else:
+                candidates = [v for v in data_vars if vi_type.lower() in v.lower()]
+                if not candidates:
+                    return {'status': 'skip', 'vi_type': vi_type,
+                            'message': f"Variable {vi_type} not found in {filename}"}
+                var = ds.variables[candidates[0]]
+
+            source_crs = detect_nc_crs(ds, var)
+            if source_crs is None:
+                return {'status': 'skip', 'vi_type': vi_type, 'message': f"No CRS in {filename}"}
+
+            n_obs, n_y, n_x = var.shape
+            if n_obs == 0:
+                return {'status': 'skip', 'vi_type': vi_type, 'message': f"No time steps in {filename}"}
+
+            src_transform = transform_from_coords(ds.variables['x'][:], ds.variables['y'][:])
+
+            # Fused range test + count over one chunk row at a time.
+            vmin, vmax = get_valid_range(vi_type)
+            count_valid = np.zeros((n_y, n_x), dtype=np.uint32)
+            for y0, block in iter_chunk_rows(var):
+                valid_count_accumulate(block, vmin, vmax, count_valid[y0:y0 + block.shape[1]])
 
         count_tmp = os.path.join(temp_dir, f"{tile_id}_{vi_type}_count.tif")
-        reproj_count.encoding.clear()
-        reproj_count.rio.write_nodata(0, encoded=True, inplace=True)
-        reproj_count.rio.to_raster(count_tmp, compress=GEOTIFF_COMPRESS,
-                                   tiled=True,
-                                   blockxsize=GEOTIFF_BLOCK_SIZE, blockysize=GEOTIFF_BLOCK_SIZE,
-                                   dtype='uint16')
-
-        ds.close()
+        with gdal_env(N_WORKERS):
+            reproj_count, dst_transform = reproject_array(
+                to_uint16(count_valid), src_transform, source_crs, target_crs,
+                reproject_resolution(target_crs), nodata=0,
+                num_threads=worker_threads(N_WORKERS), warp_mem_limit=512,
+            )
+            # Uncompressed: the temp tile is read back once and re-encoded
+            # into the mosaic, so compressing it would only cost CPU twice
+            profile = dict(
+                driver='GTiff', dtype='uint16', count=1, nodata=0,
+                width=reproj_count.shape[1], height=reproj_count.shape[0],
+                crs=target_crs, transform=dst_transform,
+                **geotiff_options('uint16', compress='NONE'),
+            )
+            with rasterio.open(count_tmp, 'w', **profile) as dst:
+                dst.write(reproj_count, 1)
+
         return {
             'status':     'ok',
+            'vi_type':    vi_type,
             'count_path': count_tmp,
             'message':    f"OK ({n_obs} obs): {tile_id}",
         }
 
     except Exception as e:
-        return {'status': 'error', 'message': f"Error ({tile_id}): {e}"}
-
-
-# =============================================================================
-# MOSAIC HELPER
-# =============================================================================
-
-def _mosaic_tiles(tile_paths: list, nodata, dtype: str) -> tuple:
-    """Stream-merge temp tile GeoTIFFs. Returns (array, transform, crs)."""
-    src_files = []
-    try:
-        src_files = [rasterio.open(p) for p in tile_paths]
-        mosaic, transform = rasterio_merge(src_files, nodata=nodata)
-        crs = src_files[0].crs
-        return mosaic[0].astype(dtype), transform, crs
-    finally:
-        for src in src_files:
-            src.close()
+        return {'status': 'error', 'vi_type': vi_type, 'message': f"Error ({tile_id}): {e}"}
 
 
 # =============================================================================
@@ -153,7 +167,7 @@ def _mosaic_tiles(tile_paths: list, nodata, dtype: str) -> tuple:
 def build_count_valid_mosaic(processed_vis: list):
     safe_crs = TARGET_CRS.replace(':', '')
 
-    all_nc = glob.glob(os.path.join(NETCDF_DIR, "**", "*.nc"), recursive=True)
+    all_nc = list(find_files(NETCDF_DIR, ".nc"))
     all_nc = filter_by_configured_tiles(all_nc)
     if not all_nc:
         logger.error(f"No NetCDF files found in {NETCDF_DIR}")
@@ -166,12 +180,15 @@ def build_count_valid_mosaic(processed_vis: list):
         vmin, vmax = get_valid_range(vi)
         logger.info(f"  Valid range  {vi}: [{vmin}, {vmax}]")
 
+    nc_by_vi = group_by_vi(all_nc, processed_vis)
+
+    # VIs still to build → output path; tiles of every VI share one pool
+    outputs = {}
     for vi in processed_vis:
         output_path = os.path.join(MOSAIC_DIR,
                                    f"HLS_Mosaic_CountValid_{vi}_{safe_crs}.tif")
 
-        vi_nc_files = [f for f in all_nc if vi in os.path.basename(f)]
-        if not vi_nc_files:
+        if not nc_by_vi[vi]:
             logger.warning(f"[{vi}] No NetCDF files found — skipping.")
             continue
 
@@ -180,74 +197,93 @@ def build_count_valid_mosaic(processed_vis: list):
                         f"{os.path.basename(output_path)}")
             continue
 
-        logger.info(f"[{vi}] {len(vi_nc_files)} tile file(s)  →  "
+        logger.info(f"[{vi}] {len(nc_by_vi[vi])} tile file(s)  →  "
                     f"{os.path.basename(output_path)}")
+        outputs[vi] = output_path
 
-        with tempfile.TemporaryDirectory(prefix=f"hls_{vi}_countvalid_") as tmp_dir:
-            worker_args = [
-                {
-                    'nc_path': nc, 'vi_type': vi,
-                    'target_crs': TARGET_CRS, 'temp_dir': tmp_dir,
-                }
-                for nc in vi_nc_files
-            ]
-
-            count_tile_paths = []
-            n_skipped = n_errors = 0
-            n_total = len(worker_args)
-            n_done = 0
-
-            with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-                futures = {executor.submit(_process_tile, a): a
-                           for a in worker_args}
-                for future in as_completed(futures):
-                    n_done += 1
-                    result = future.result()
-                    if result['status'] == 'ok':
-                        count_tile_paths.append(result['count_path'])
-                        logger.info(f"  [{n_done}/{n_total}] {result['message']}")
-                    elif result['status'] == 'skip':
-                        n_skipped += 1
-                        logger.info(f"  [{n_done}/{n_total}] skip  {result['message']}")
-                    else:
-                        n_errors += 1
-                        logger.error(f"  [{n_done}/{n_total}] error {result['message']}")
-
-            if not count_tile_paths:
-                logger.warning(f"  No tiles produced for {vi} — skipping mosaic.")
-                continue
-
-            logger.info(f"  Mosaicking {len(count_tile_paths)} tile(s) "
-                        f"({n_skipped} skipped, {n_errors} errors)...")
-
-            try:
-                mosaic, transform, crs = _mosaic_tiles(
-                    count_tile_paths, nodata=0, dtype='uint16'
-                )
-                profile = {
-                    'driver':    'GTiff',
-                    'dtype':     'uint16',
-                    'nodata':    0,
-                    'width':     mosaic.shape[1],
-                    'height':    mosaic.shape[0],
-                    'count':     1,
-                    'crs':       crs,
-                    'transform': transform,
-                    'compress':   GEOTIFF_COMPRESS,
-                    'tiled':      True,
-                    'blockxsize': GEOTIFF_BLOCK_SIZE,
-                    'blockysize': GEOTIFF_BLOCK_SIZE,
-                    'predictor':  2,
-                }
-                with rasterio.open(output_path, 'w', **profile) as dst:
-                    dst.write(mosaic, 1)
-                    dst.set_band_description(1, "CountValid_AllDownloadCycles")
-
-                size_mb = os.path.getsize(output_path) / (1024 ** 2)
-                logger.info(f"[{vi}] Written: {os.path.basename(output_path)}"
-                            f"  ({size_mb:.1f} MB)")
-            except Exception as e:
-                logger.error(f"[{vi}] Mosaic failed: {e}")
+    if not outputs:
+        return
+
+    with tempfile.TemporaryDirectory(prefix="hls_countvalid_") as tmp_dir:
+        worker_args = [
+            {
+                'nc_path': nc, 'vi_type': vi,
+                'target_crs': TARGET_CRS, 'temp_dir': tmp_dir,
+            }
+            for vi in outputs
+            for nc in nc_by_vi[vi]
+        ]
+
+        remaining        = {vi: len(nc_by_vi[vi]) for vi in outputs}
+        count_tile_paths = {vi: [] for vi in outputs}
+        n_reused         = dict.fromkeys(outputs, 0)
+        n_skipped        = dict.fromkeys(outputs, 0)
+        n_errors         = dict.fromkeys(outputs, 0)
+        n_total = len(worker_args)
+        n_done = 0
+
+        # One pool for all VIs (work items are VI-major); each VI is mosaicked
+        # as soon as its last tile is in. Mosaics run in order on one
+        # background thread, so this thread keeps collecting results and the
+        # pool keeps working on the next VI meanwhile.
+        tiles_done = threading.Event()
+        mosaics    = []
+        with ProcessPoolExecutor(max_workers=N_WORKERS) as executor, \
+                ThreadPoolExecutor(max_workers=1) as mosaicker:
+            for result in imap_bounded(executor, _process_tile, worker_args, 2 * N_WORKERS):
+                n_done += 1
+                vi = result['vi_type']
+                if result['status'] == 'ok':
+                    count_tile_paths[vi].append(result['count_path'])
+                    n_reused[vi] += result.get('reused', False)
+                    logger.info(f"  [{n_done}/{n_total}] {result['message']}")
+                elif result['status'] == 'skip':
+                    n_skipped[vi] += 1
+                    logger.info(f"  [{n_done}/{n_total}] skip  {result['message']}")
+                else:
+                    n_errors[vi] += 1
+                    logger.error(f"  [{n_done}/{n_total}] error {result['message']}")
+
+                remaining[vi] -= 1
+                if remaining[vi] == 0:
+                    mosaics.append(mosaicker.submit(
+                        _mosaic_vi, vi, count_tile_paths[vi], outputs[vi],
+                        n_reused[vi], n_skipped[vi], n_errors[vi], tiles_done))
+            tiles_done.set()
+            for future in mosaics:
+                future.result()
+
+
+def _mosaic_vi(vi: str, count_tile_paths: list, output_path: str, n_reused: int,
+               n_skipped: int, n_errors: int, tiles_done: threading.Event):
+    """Stream-merge one VI's per-tile count GeoTIFFs into its mosaic.
+
+    Runs on the mosaic thread. While tiles are still being processed it runs
+    beside N_WORKERS busy workers and takes one worker's share of the cores
+    for GDAL and block threads; once every tile is in it uses all of them.
+    """
+    if not count_tile_paths:
+        logger.warning(f"  No tiles produced for {vi} — skipping mosaic.")
+        return
+
+    logger.info(f"  [{vi}] Mosaicking {len(count_tile_paths)} tile(s) "
+                f"({n_reused} reused from step 05, {len(count_tile_paths) - n_reused} recomputed, "
+                f"{n_skipped} skipped, {n_errors} errors)...")
+
+    share = 1 if tiles_done.is_set() else N_WORKERS
+    try:
+        with gdal_env(share):
+            streaming_merge(
+                count_tile_paths, output_path, nodata=0, dtype='uint16',
+                description='CountValid_AllDownloadCycles', num_threads=worker_threads(share),
+                **geotiff_options('uint16'),
+            )
+
+        size_mb = os.path.getsize(output_path) / (1024 ** 2)
+        logger.info(f"[{vi}] Written: {os.path.basename(output_path)}"
+                    f"  ({size_mb:.1f} MB)")
+    except Exception as e:
+        logger.error(f"[{vi}] Mosaic failed: {e}")
 
 
 # =============================================================================
@@ -11,7 +11,8 @@
 #   2. Computes per-pixel mean AND count_valid (observations with valid data)
 #   3. Reprojects each tile to TARGET_CRS at 30m
 #   4. Mosaics all tiles into a continent-wide raster
-#   5. Appends the result as a new band in two multi-band GeoTIFF stacks:
+#   5. Stages the result as one band of two multi-band GeoTIFF stacks,
+#      which are written once all windows are done:
 #        HLS_TimeSeries_{VI}_Mean_{CRS}.tif       — N bands, float32
 #        HLS_TimeSeries_{VI}_CountValid_{CRS}.tif — N bands, uint16
 #
@@ -27,17 +28,20 @@
 
 import os
 import re
-import glob
+import shutil
 import warnings
 import numpy as np
 import pandas as pd
-import xarray as xr
-import rioxarray         # noqa: F401 — activates .rio accessor
+import netCDF4 as nc4
 import rasterio
-from rasterio.merge import merge as rasterio_merge
 import tempfile
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from hls_utils import filter_by_configured_tiles, get_valid_range, detect_crs, reproject_resolution, setup_logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hls_kernels import range_sum_accumulate, set_worker_threads, to_uint16
+from hls_utils import (filter_by_configured_tiles, find_files, gdal_env, geotiff_options,
+                       get_valid_range, detect_nc_crs, group_by_vi, imap_bounded, iter_chunk_rows,
+                       reproject_array, reproject_resolution, setup_logging, streaming_merge,
+                       transform_from_coords, worker_threads)
 
 logger = setup_logging("10_timeseries")
 
@@ -53,8 +57,6 @@ PROCESSED_VIS  = os.environ.get("PROCESSED_VIS",        "NDVI EVI2 NIRv").split(
 N_WORKERS          = int(os.environ.get("NUM_WORKERS",       4))
 TIMESLICE_STAT     = os.environ.get("TIMESLICE_STAT",       "mean").lower()
 _WINDOWS_RAW       = os.environ.get("TIMESLICE_WINDOWS",    "")
-GEOTIFF_COMPRESS   = os.environ.get("GEOTIFF_COMPRESS",     "LZW").upper()
-GEOTIFF_BLOCK_SIZE = int(os.environ.get("GEOTIFF_BLOCK_SIZE", 512))
 
 if not NETCDF_DIR or not OUTPUT_DIR:
     raise ValueError("NETCDF_DIR or TIMESLICE_OUTPUT_DIR not set in environment.")
@@ -128,185 +130,193 @@ def parse_windows(windows_str: str) -> list:
 # PER-TILE WORKER
 # =============================================================================
 
+def _window_mean_count(var, t_index, vmin, vmax):
+    """Per-pixel mean and count of the in-range values of *var* over *t_index*.
+
+    Streams the selected time steps one on-disk chunk row at a time into a
+    running sum/count (range test, sum and count fused in one Numba pass),
+    so the windowed (T, Y, X) cube is never held in memory. Returns
+    (mean float32, NaN where no value was valid; count uint16).
+    """
+    _, n_y, n_x = var.shape
+    total = np.zeros((n_y, n_x), dtype=np.float64)
+    count = np.zeros((n_y, n_x), dtype=np.uint32)
+    for y0, block in iter_chunk_rows(var, t_index=t_index):
+        rows = slice(y0, y0 + block.shape[1])
+        range_sum_accumulate(block, vmin, vmax, total[rows], count[rows])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (total / count).astype(np.float32)
+    return mean, to_uint16(count)
+
+
 def _process_tile_window(args: dict) -> dict:
     """
     Worker: filter one tile NetCDF to a time window, compute mean +
-    count_valid, reproject, write two temp GeoTIFFs.
+    count_valid, reproject, write two temp GeoTIFFs. Every result carries
+    'group' (vi_type, window index) so the caller can route it to that
+    window's mosaic.
     """
-    import dask
-
     nc_path      = args['nc_path']
     vi_type      = args['vi_type']
+    group        = (vi_type, args['window_idx'])
     window_label = args['window_label']
     window_start = args['window_start']
     window_end   = args['window_end']
     target_crs   = args['target_crs']
     temp_dir     = args['temp_dir']
-    stat         = args['stat']
 
     filename = os.path.basename(nc_path)
     tile_id  = filename.split('_')[0] if '_' in filename else filename.replace('.nc', '')
 
     try:
-        ds = xr.open_dataset(nc_path, chunks='auto')
-
-        if vi_type in ds.data_vars:
-            da = ds[vi_type]
-        else:
-            candidates = [v for v in ds.data_vars if vi_type.lower() in v.lower()]
-            if not candidates:
-                ds.close()
-                return {'status': 'skip',
-                        'message': f"Variable {vi_type} not found in {filename}"}
-            da = ds[candidates[0]]
-
-        source_crs = detect_crs(ds, da)
-        if source_crs is None:
-            ds.close()
-            return {'status': 'skip', 'message': f"No CRS in {filename}"}
-
-        # --- Filter time dimension to window ---
-        time_vals = pd.to_datetime(
-            ds['time'].values, unit='D', origin='unix'
-        ) if ds['time'].dtype.kind in ('i', 'u') else pd.DatetimeIndex(ds['time'].values)
-
-        time_mask = (time_vals >= window_start) & (time_vals <= window_end)
-        n_obs     = int(time_mask.sum())
-
-        if n_obs == 0:
-            ds.close()
-            return {
-                'status':  'skip',
-                'message': f"No observations in [{window_start.date()} – "
-                           f"{window_end.date()}] for {tile_id}",
-            }
-
-        da_window = da.isel(time=np.where(time_mask)[0])
-
-        # Use per-VI valid range bounds from config.env.
-        # Pixels outside the range are excluded from the mean and count_valid.
-        vmin, vmax = get_valid_range(vi_type)
-        valid      = da_window.where((da_window >= vmin) & (da_window <= vmax))
-
-        # dask.config.set replaces xr.set_options(scheduler=...) which was
-        # removed in xarray 2024.x. Prevents nested thread pools inside workers.
-        with dask.config.set(scheduler='synchronous'):
-            result      = valid.mean(dim='time', skipna=True).compute()
-            count_valid = valid.count(dim='time').compute()
-
-        result.rio.write_crs(source_crs, inplace=True)
-        count_valid.rio.write_crs(source_crs, inplace=True)
-
-        reproj_mean  = result.rio.reproject(target_crs, resolution=reproject_resolution(target_crs), nodata=np.nan)
-        reproj_count = count_valid.rio.reproject(target_crs, resolution=reproject_resolution(target_crs), nodata=0)
-        reproj_count = reproj_count.fillna(0).astype('uint16')
+        set_worker_threads(N_WORKERS)
+
+        with nc4.Dataset(nc_path, 'r') as ds:
+            data_vars = [v for v in ds.variables if v not in ds.dimensions]
+            if vi_type in data_vars:
+                var = ds.variables[vi_type]
+            else:
+                candidates = [v for v in data_vars if vi_type.lower() in v.lower()]
+                if not candidates:
+                    return {'status': 'skip', 'group': group,
+                            'message': f"Variable {vi_type} not found in {filename}"}
+                var = ds.variables[candidates[0]]
+
+            source_crs = detect_nc_crs(ds, var)
+            if source_crs is None:
+                return {'status': 'skip', 'group': group, 'message': f"No CRS in {filename}"}
+
+            # --- Filter time dimension to window (int days since 1970-01-01) ---
+            time_vals = pd.to_datetime(
+                np.asarray(ds.variables['time'][:], dtype='int64'), unit='D', origin='unix'
+            )
+            t_index = np.flatnonzero((time_vals >= window_start) & (time_vals <= window_end))
+            n_obs   = len(t_index)
+
+            if n_obs == 0:
+                return {
+                    'status':  'skip',
+                    'group':   group,
+                    'message': f"No observations in [{window_start.date()} – "
+                               f"{window_end.date()}] for {tile_id}",
+                }
+
+            # Use per-VI valid range bounds from config.env.
+            # Pixels outside the range are excluded from the mean and count_valid.
+            vmin, vmax = get_valid_range(vi_type)
+            src_transform = transform_from_coords(ds.variables['x'][:], ds.variables['y'][:])
+            mean, count_valid = _window_mean_count(var, t_index, vmin, vmax)
 
         safe_label = re.sub(r'[^A-Za-z0-9_]', '_', window_label)
         mean_tmp   = os.path.join(temp_dir, f"{tile_id}_{vi_type}_{safe_label}_mean.tif")
         count_tmp  = os.path.join(temp_dir, f"{tile_id}_{vi_type}_{safe_label}_count.tif")
 
-        reproj_mean.encoding.clear()
-        reproj_mean.rio.to_raster(mean_tmp, compress=GEOTIFF_COMPRESS,
-                                   tiled=True,
-                                   blockxsize=GEOTIFF_BLOCK_SIZE, blockysize=GEOTIFF_BLOCK_SIZE,
-                                   dtype='float32', nodata=np.nan)
+        resolution = reproject_resolution(target_crs)
+        warp_opts  = dict(num_threads=worker_threads(N_WORKERS), warp_mem_limit=512)
+        with gdal_env(N_WORKERS):
+            # The count is cast on the source grid, so the warp writes uint16
+            # into a zero-initialised destination and needs no post-pass
+            reproj_mean, dst_transform = reproject_array(
+                mean, src_transform, source_crs, target_crs, resolution,
+                nodata=np.nan, **warp_opts,
+            )
+            reproj_count, _ = reproject_array(
+                count_valid, src_transform, source_crs, target_crs, resolution,
+                nodata=0, dst_grid=(dst_transform, reproj_mean.shape), **warp_opts,
+            )
 
-        reproj_count.encoding.clear()
-        reproj_count.rio.write_nodata(0, encoded=True, inplace=True)
-        reproj_count.rio.to_raster(count_tmp, compress=GEOTIFF_COMPRESS,
-                                    tiled=True,
-                                    blockxsize=GEOTIFF_BLOCK_SIZE, blockysize=GEOTIFF_BLOCK_SIZE,
-                                    dtype='uint16')
+            # Temp tiles are uncompressed: each is read back once by the
+            # mosaic, which does the only compression pass
+            _write_temp_tif(mean_tmp, reproj_mean, dst_transform, target_crs, 'float32', np.nan)
+            _write_temp_tif(count_tmp, reproj_count, dst_transform, target_crs, 'uint16', 0)
 
-        ds.close()
         return {
             'status':     'ok',
+            'group':      group,
             'mean_path':  mean_tmp,
             'count_path': count_tmp,
             'message':    f"OK ({n_obs} obs): {tile_id} / {window_label}",
         }
 
     except Exception as e:
-        return {'status': 'error', 'message': f"Error ({tile_id} / {window_label}): {e}"}
+        return {'status': 'error', 'group': group, 'message': f"Error ({tile_id} / {window_label}): {e}"}
 
 
-# =============================================================================
-# MOSAIC HELPER
-# =============================================================================
-
-def _mosaic_temp_tiles(tile_paths: list, nodata, dtype: str) -> tuple:
-    """Stream-merge temp tile GeoTIFFs. Returns (array, transform, crs)."""
-    src_files = []
-    try:
-        src_files = [rasterio.open(p) for p in tile_paths]
-        mosaic, transform = rasterio_merge(src_files, nodata=nodata)
-        crs = src_files[0].crs
-        return mosaic[0].astype(dtype), transform, crs
-    finally:
-        for src in src_files:
-            src.close()
+def _write_temp_tif(path, arr, transform, crs, dtype, nodata):
+    """Write a single-band uncompressed temp GeoTIFF."""
+    profile = dict(
+        driver='GTiff', dtype=dtype, count=1, nodata=nodata,
+        width=arr.shape[1], height=arr.shape[0], crs=crs, transform=transform,
+        **geotiff_options(dtype, compress='NONE'),
+    )
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr, 1)
 
 
 # =============================================================================
 # STACK WRITER
 # =============================================================================
 
-def _append_band_to_stack(stack_path: str, band_data: np.ndarray,
-                           transform, crs, band_label: str,
-                           dtype: str, nodata, predictor: int) -> int:
+def _stage_band(band_dir: str, tile_paths: list, window_idx: int, band_label: str,
+                dtype: str, nodata, staged: dict, num_threads=None):
     """
-    Create or append a band to a multi-band GeoTIFF stack.
-    Band descriptions are set to band_label for self-documenting output.
-    Uses atomic write-then-replace to keep the stack file always valid.
-    Existing bands are copied via windowed streaming reads to avoid loading
-    the entire stack into RAM (important for large stacks with many windows).
+    Mosaic one window's temp tiles straight into a single-band GeoTIFF in
+    band_dir (streaming_merge: one output block at a time, no full mosaic in
+    RAM) and record it as staged[window_idx] = (path, label). Staged bands
+    are full-extent and live until the stack is written, so they use the
+    normal compressed geotiff_options rather than uncompressed temp tiles.
+    Every band of a stack must share the grid of the bands already staged;
+    a mismatch raises ValueError and the band is left out.
     """
-    if not os.path.exists(stack_path):
-        profile = {
-            'driver': 'GTiff', 'dtype': dtype, 'nodata': nodata,
-            'width': band_data.shape[1], 'height': band_data.shape[0],
-            'count': 1, 'crs': crs, 'transform': transform,
-            'compress': GEOTIFF_COMPRESS, 'tiled': True,
-            'blockxsize': GEOTIFF_BLOCK_SIZE, 'blockysize': GEOTIFF_BLOCK_SIZE,
-            'predictor': predictor,
-            'BIGTIFF': 'YES',   # 64-bit offsets — required when stack exceeds 4 GB
-        }
-        with rasterio.open(stack_path, 'w', **profile) as dst:
-            dst.write(band_data, 1)
-            dst.update_tags(1, label=band_label)
-            dst.set_band_description(1, band_label)
-        return 1
+    band_path = os.path.join(band_dir, f"band_{window_idx:03d}.tif")
+    streaming_merge(tile_paths, band_path, nodata=nodata, dtype=dtype, num_threads=num_threads,
+                    BIGTIFF='IF_SAFER', **geotiff_options(dtype))
+
+    if staged:
+        ref_path = next(iter(staged.values()))[0]
+        with rasterio.open(ref_path) as ref, rasterio.open(band_path) as band:
+            same_grid = ref.shape == band.shape and ref.transform == band.transform
+            ref_size = f"{ref.width}x{ref.height}"
+        if not same_grid:
+            os.remove(band_path)
+            raise ValueError(f"mosaic grid differs from the other bands ({ref_size})")
+    staged[window_idx] = (band_path, band_label)
+
+
+def _write_stack(stack_path: str, staged: dict) -> int:
+    """
+    Assemble the staged single-band GeoTIFFs into one multi-band stack, in
+    window order. Band descriptions and 'label' tags are set to each band's
+    label for self-documenting output. Each band is copied block by block
+    once, so building an N-band stack moves O(N) data instead of rewriting
+    every earlier band on each append. Each staged file is deleted as soon
+    as it has been copied, so temp disk shrinks while the stack grows. Uses
+    atomic write-then-replace so a stack file on disk is always complete.
+    Returns the band count.
+    """
+    bands = [staged[w_idx] for w_idx in sorted(staged)]
+    with rasterio.open(bands[0][0]) as first:
+        profile = first.profile.copy()
+    profile.update(count=len(bands), **geotiff_options(profile['dtype']))
+    profile['BIGTIFF'] = 'YES'   # 64-bit offsets — required when stack exceeds 4 GB
 
     tmp_path = stack_path + '.tmp'
     try:
-        with rasterio.open(stack_path, 'r') as src:
-            existing_count = src.count
-            existing_descs = list(src.descriptions)
-            profile        = src.profile.copy()
-            profile.update(count=existing_count + 1)
-            profile['BIGTIFF'] = 'YES'   # Ensure .tmp is also BigTIFF
-
-            with rasterio.open(tmp_path, 'w', **profile) as dst:
-                # Stream existing bands block-by-block — no full-stack RAM load
-                for b_idx in range(1, existing_count + 1):
-                    for _, window in src.block_windows(b_idx):
-                        dst.write(src.read(b_idx, window=window), b_idx, window=window)
-                    dst.set_band_description(b_idx, existing_descs[b_idx - 1] or "")
-
-                # Write the new band
-                new_band = existing_count + 1
-                dst.write(band_data, new_band)
-                dst.update_tags(new_band, label=band_label)
-                dst.set_band_description(new_band, band_label)
-
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for b_idx, (band_path, band_label) in enumerate(bands, 1):
+                with rasterio.open(band_path) as src:
+                    for _, window in dst.block_windows(b_idx):
+                        dst.write(src.read(1, window=window), b_idx, window=window)
+                dst.update_tags(b_idx, label=band_label)
+                dst.set_band_description(b_idx, band_label)
+                os.remove(band_path)
         os.replace(tmp_path, stack_path)
-
     except Exception:
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
         raise
 
-    return existing_count + 1
+    return len(bands)
 
 
 # =============================================================================
@@ -316,7 +326,7 @@ def _append_band_to_stack(stack_path: str, band_data: np.ndarray,
 def build_timeseries_stacks(windows: list, processed_vis: list):
     safe_crs = TARGET_CRS.replace(':', '')
 
-    all_nc = glob.glob(os.path.join(NETCDF_DIR, "**", "*.nc"), recursive=True)
+    all_nc = list(find_files(NETCDF_DIR, ".nc"))
     all_nc = filter_by_configured_tiles(all_nc)
     if not all_nc:
         logger.error(f"No NetCDF files found in {NETCDF_DIR}")
@@ -330,11 +340,15 @@ def build_timeseries_stacks(windows: list, processed_vis: list):
         vmin, vmax = get_valid_range(vi)
         logger.info(f"  Valid range  {vi}: [{vmin}, {vmax}]")
 
+    nc_by_vi = group_by_vi(all_nc, processed_vis)
+
+    # VIs to build → (mean stack path, count stack path)
+    stacks = {}
     for vi in processed_vis:
         mean_stack_path  = os.path.join(OUTPUT_DIR, f"HLS_TimeSeries_{vi}_Mean_{safe_crs}.tif")
         count_stack_path = os.path.join(OUTPUT_DIR, f"HLS_TimeSeries_{vi}_CountValid_{safe_crs}.tif")
 
-        vi_nc_files = [f for f in all_nc if vi in os.path.basename(f)]
+        vi_nc_files = nc_by_vi[vi]
         if not vi_nc_files:
             logger.warning(f"[{vi}] No NetCDF files found — skipping.")
             continue
@@ -348,75 +362,136 @@ def build_timeseries_stacks(windows: list, processed_vis: list):
             if os.path.exists(p):
                 logger.warning(f"  Removing existing stack: {os.path.basename(p)}")
                 os.remove(p)
+        stacks[vi] = (mean_stack_path, count_stack_path)
 
-        for w_idx, window in enumerate(windows, 1):
-            label = window['label']
-            start = window['start']
-            end   = window['end']
-            logger.info(f"  [{vi}] Window {w_idx}/{len(windows)}: {label}  "
-                        f"({start.date()} – {end.date()})")
+    if not stacks:
+        return
 
-            with tempfile.TemporaryDirectory(prefix=f"hls_{vi}_{label}_") as tmp_dir:
-                worker_args = [
+    with tempfile.TemporaryDirectory(prefix="hls_timeseries_") as tmp_dir:
+        # One work group per (VI, window): its temp tiles get their own
+        # directory, removed as soon as the window's bands are staged
+        groups      = {}
+        worker_args = []
+        for vi in stacks:
+            for w_idx, window in enumerate(windows, 1):
+                tile_dir = os.path.join(tmp_dir, f"{vi}_{w_idx:03d}")
+                os.makedirs(tile_dir)
+                groups[(vi, w_idx)] = {
+                    'tile_dir': tile_dir, 'remaining': len(nc_by_vi[vi]),
+                    'mean_paths': [], 'count_paths': [], 'n_skipped': 0, 'n_errors': 0,
+                }
+                worker_args += [
                     {
-                        'nc_path': nc, 'vi_type': vi,
-                        'window_label': label, 'window_start': start,
-                        'window_end': end, 'target_crs': TARGET_CRS,
-                        'temp_dir': tmp_dir, 'stat': TIMESLICE_STAT,
+                        'nc_path': nc, 'vi_type': vi, 'window_idx': w_idx,
+                        'window_label': window['label'], 'window_start': window['start'],
+                        'window_end': window['end'], 'target_crs': TARGET_CRS,
+                        'temp_dir': tile_dir,
                     }
-                    for nc in vi_nc_files
+                    for nc in nc_by_vi[vi]
                 ]
 
-                mean_tile_paths  = []
-                count_tile_paths = []
-                n_skipped = n_errors = 0
-
-                with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-                    futures = {executor.submit(_process_tile_window, a): a
-                               for a in worker_args}
-                    for future in as_completed(futures):
-                        result = future.result()
-                        if result['status'] == 'ok':
-                            mean_tile_paths.append(result['mean_path'])
-                            count_tile_paths.append(result['count_path'])
-                        elif result['status'] == 'skip':
-                            n_skipped += 1
-                            logger.info(f"    skip  {result['message']}")
-                        else:
-                            n_errors += 1
-                            logger.error(f"    error {result['message']}")
-
-                if not mean_tile_paths:
-                    logger.warning(f"    No tiles produced for window '{label}' — skipping band.")
+        # Staged band files per VI, keyed by window index
+        staged       = {vi: {'mean': {}, 'count': {}} for vi in stacks}
+        windows_left = dict.fromkeys(stacks, len(windows))
+        for vi in stacks:
+            for kind in staged[vi]:
+                os.makedirs(os.path.join(tmp_dir, f"{vi}_bands", kind))
+
+        # One pool for every (VI, window, tile) item (VI-major, then window);
+        # each window is mosaicked as soon as its last tile is in, and each
+        # VI's stacks are written once its last window is staged. Mosaics and
+        # stack writes run in order on one background thread, so this thread
+        # keeps collecting results and the pool keeps working meanwhile.
+        tiles_done = threading.Event()
+        mosaics    = []
+        with ProcessPoolExecutor(max_workers=N_WORKERS) as executor, \
+                ThreadPoolExecutor(max_workers=1) as mosaicker:
+            for result in imap_bounded(executor, _process_tile_window, worker_args,
+                                       2 * N_WORKERS):
+                vi, w_idx = result['group']
+                group = groups[(vi, w_idx)]
+                if result['status'] == 'ok':
+                    group['mean_paths'].append(result['mean_path'])
+                    group['count_paths'].append(result['count_path'])
+                elif result['status'] == 'skip':
+                    group['n_skipped'] += 1
+                    logger.info(f"    skip  {result['message']}")
+                else:
+                    group['n_errors'] += 1
+                    logger.error(f"    error {result['message']}")
+
+                group['remaining'] -= 1
+                if group['remaining'] > 0:
                     continue
+                mosaics.append(mosaicker.submit(
+                    _mosaic_window, vi, w_idx, windows, group,
+                    os.path.join(tmp_dir, f"{vi}_bands"), staged[vi], tiles_done))
 
-                logger.info(f"    Mosaicking {len(mean_tile_paths)} tile(s) "
-                            f"({n_skipped} skipped, {n_errors} errors)...")
+                windows_left[vi] -= 1
+                if windows_left[vi] == 0:
+                    mosaics.append(mosaicker.submit(
+                        _finish_stacks, vi, stacks[vi], staged[vi], tiles_done))
+            tiles_done.set()
+            for future in mosaics:
+                future.result()
 
-                try:
-                    mean_mosaic, transform, crs = _mosaic_temp_tiles(
-                        mean_tile_paths, nodata=np.nan, dtype='float32'
-                    )
-                    band_num = _append_band_to_stack(
-                        mean_stack_path, mean_mosaic, transform, crs,
-                        band_label=label, dtype='float32', nodata=np.nan, predictor=3
-                    )
-                    logger.info(f"    Mean band {band_num} written: '{label}'")
-                except Exception as e:
-                    logger.error(f"    Mean mosaic failed for '{label}': {e}")
-                    continue
 
+def _mosaic_share(tiles_done: threading.Event) -> int:
+    """Pool size to split a background mosaic's GDAL and block threads by.
+
+    While tiles are still being processed a mosaic runs beside N_WORKERS
+    busy workers and takes one worker's share of the cores; once every tile
+    is in it has the machine to itself.
+    """
+    return 1 if tiles_done.is_set() else N_WORKERS
+
+
+def _mosaic_window(vi: str, w_idx: int, windows: list, group: dict,
+                   band_dir: str, staged: dict, tiles_done: threading.Event):
+    """Stage one (VI, window)'s mean and count mosaics as bands of its stacks,
+    then delete the window's temp tiles. Runs on the mosaic thread."""
+    window = windows[w_idx - 1]
+    label  = window['label']
+    logger.info(f"  [{vi}] Window {w_idx}/{len(windows)}: {label}  "
+                f"({window['start'].date()} – {window['end'].date()})")
+
+    try:
+        if not group['mean_paths']:
+            logger.warning(f"    No tiles produced for window '{label}' — skipping band.")
+            return
+
+        logger.info(f"    Mosaicking {len(group['mean_paths'])} tile(s) "
+                    f"({group['n_skipped']} skipped, {group['n_errors']} errors)...")
+
+        share = _mosaic_share(tiles_done)
+        with gdal_env(share):
+            for kind, name, dtype, nodata in [('mean',  'Mean',       'float32', np.nan),
+                                              ('count', 'CountValid', 'uint16',  0)]:
                 try:
-                    count_mosaic, transform, crs = _mosaic_temp_tiles(
-                        count_tile_paths, nodata=0, dtype='uint16'
-                    )
-                    band_num = _append_band_to_stack(
-                        count_stack_path, count_mosaic, transform, crs,
-                        band_label=label, dtype='uint16', nodata=0, predictor=2
-                    )
-                    logger.info(f"    CountValid band {band_num} written: '{label}'")
+                    _stage_band(os.path.join(band_dir, kind), group[f'{kind}_paths'], w_idx,
+                                band_label=label, dtype=dtype, nodata=nodata, staged=staged[kind],
+                                num_threads=worker_threads(share))
+                    logger.info(f"    {name} band staged: '{label}'")
                 except Exception as e:
-                    logger.error(f"    Count mosaic failed for '{label}': {e}")
+                    logger.error(f"    {name} mosaic failed for '{label}': {e}")
+                    return
+    finally:
+        shutil.rmtree(group['tile_dir'], ignore_errors=True)
+
+
+def _finish_stacks(vi: str, stack_paths: tuple, staged: dict, tiles_done: threading.Event):
+    """Write one VI's mean and count stacks from its staged bands and log a summary.
+    Runs on the mosaic thread."""
+    with gdal_env(_mosaic_share(tiles_done)):
+        mean_stack_path, count_stack_path = stack_paths
+        for stack_path, stack_name, bands in [(mean_stack_path, "Mean", staged['mean']),
+                                              (count_stack_path, "CountValid", staged['count'])]:
+            if not bands:
+                continue
+            try:
+                _write_stack(stack_path, bands)
+            except Exception as e:
+                logger.error(f"[{vi}] {stack_name} stack write failed: {e}")
 
         # Final stack summary
         for stack_path, stack_name in [(mean_stack_path, "Mean"),
@@ -11,31 +11,38 @@
 #
 # Output: one GeoPackage per VI in OUTLIER_GPKG_DIR, e.g.:
 #   HLS_outliers_NDVI.gpkg
+# (OUTLIER_FORMAT=PARQUET writes HLS_outliers_NDVI.parquet instead)
 #
 # Feature attributes: tile_id, vi_type, sensor, date, vi_value
 # Geometry: Point (WGS84 / EPSG:4326), one point per pixel centroid
 #
 # Memory-efficient design:
-#   - Sequential tile processing — only one tile's data in RAM at a time
-#   - Time-axis chunked loading (TIME_CHUNK slices per iteration) — avoids
-#     loading the full 3-D array into memory at once
-#   - Streaming fiona writes — each chunk is written and freed immediately,
-#     no cross-tile accumulation in the main process
+#   - Parallel extraction — NUM_WORKERS processes each reduce one time
+#     group (one HDF5 time chunk) of a tile to compact outlier columns, so a
+#     result never holds more than one time group's outliers; the main
+#     process is the single writer
+#   - Chunk-aligned loading (one HDF5 chunk row — a time group × row band —
+#     per iteration) — avoids loading the full 3-D array into memory at once
+#     and decompresses every chunk exactly once
+#   - Streaming fiona writes — tiles are written in WRITE_BATCH-feature
+#     transactions and freed, never accumulated for a whole VI
 #
 # Author:  Stephen Conklin <stephenconklin@gmail.com>
 #          https://github.com/stephenconklin
 # License: MIT
 
 import os
-import gc
-import glob
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
 import fiona
 import numpy as np
-import pandas as pd
 import netCDF4 as nc4
 from pyproj import Transformer
-from hls_utils import filter_by_configured_tiles, get_valid_range, setup_logging
+from hls_kernels import find_outliers, set_worker_threads
+from hls_utils import (chunk_steps, filter_by_configured_tiles, find_files, get_valid_range,
+                       group_by_vi, imap_bounded, iter_chunk_rows, setup_logging)
 
 logger = setup_logging("11_outlier_gpkg")
 
@@ -45,11 +52,28 @@ warnings.filterwarnings("ignore")
 INPUT_FOLDER  = os.environ.get("NETCDF_DIR",        "")
 OUTPUT_FOLDER = os.environ.get("OUTLIER_GPKG_DIR",  "")
 PROCESSED_VIS = os.environ.get("PROCESSED_VIS",     "NDVI EVI2 NIRv").split()
+OUTPUT_FORMAT = os.environ.get("OUTLIER_FORMAT",    "GPKG").upper()
+N_WORKERS     = int(os.environ.get("NUM_WORKERS",   4))
 
-# Number of time slices loaded per iteration — lower values use less memory.
-# 10 is a safe default for large tiles; raise to 20–50 if RAM allows.
+# Number of time slices loaded per iteration for NetCDF variables stored
+# contiguously (chunked variables are read one HDF5 chunk row at a time) —
+# lower values use less memory. 10 is a safe default for large tiles.
 TIME_CHUNK = 10
 
+# Features buffered before each writerecords call. Every call is one OGR
+# transaction, so small chunks are coalesced (across chunks and tiles) into
+# fewer, larger commits.
+WRITE_BATCH = 50_000
+
+# OUTLIER_FORMAT → (OGR driver, file extension, layer creation options).
+# Parquet is columnar and ZSTD-compressed, for analytical consumers; it needs
+# a GDAL build with the Arrow/Parquet driver (e.g. conda-forge
+# libgdal-arrow-parquet).
+OUTPUT_FORMATS = {
+    "GPKG":    ("GPKG",    "gpkg",    {}),
+    "PARQUET": ("Parquet", "parquet", {"COMPRESSION": "ZSTD"}),
+}
+
 GPKG_SCHEMA = {
     "geometry": "Point",
     "properties": {
@@ -61,7 +85,15 @@ GPKG_SCHEMA = {
     },
 }
 
-EPOCH = pd.Timestamp("1970-01-01")
+
+@lru_cache(maxsize=64)
+def _get_transformer(crs_wkt: str) -> Transformer:
+    """Native CRS → WGS84 (lon, lat) transformer, built once per distinct CRS.
+
+    HLS tiles share a handful of UTM zones, so PROJ setup runs once per zone
+    instead of once per tile and VI.
+    """
+    return Transformer.from_crs(crs_wkt, "EPSG:4326", always_xy=True)
 
 
 def _decode_sensor(s) -> str:
@@ -71,13 +103,16 @@ def _decode_sensor(s) -> str:
     return str(s).strip()
 
 
-def iter_tile_chunks(nc_path, vi_type, vmin, vmax):
+def iter_tile_chunks(nc_path, vi_type, vmin, vmax, t_range=None):
     """
-    Generator: open one NetCDF tile, load VI data TIME_CHUNK slices at a
-    time, and yield a list of fiona feature dicts for each chunk that
-    contains outliers.
+    Generator: open one NetCDF tile, load VI data one on-disk chunk row
+    (time group × row band) at a time, and yield the outlier columns of
+    each block that contains outliers.
+
+    *t_range* (t0, t1) restricts the read to those time steps (all of them
+    when None).
 
-    Keeps only one time-chunk in memory at a time. The NetCDF dataset stays
+    Keeps only one block in memory at a time. The NetCDF dataset stays
     open across yields and is closed when the generator is exhausted or
     garbage-collected.
 
@@ -86,13 +121,14 @@ def iter_tile_chunks(nc_path, vi_type, vmin, vmax):
     nc_path       : str   — path to the NetCDF file
     vi_type       : str   — VI variable name (e.g. "NDVI")
     vmin, vmax    : float — outlier bounds (values outside → outlier)
+    t_range       : tuple — (t0, t1) time-step span to read, or None
 
     Yields
     ------
-    list[dict] — fiona feature dicts for one chunk of outliers
+    dict — "lon", "lat" (float64), "date" (datetime.date), "sensor" (str) and
+           "vi_value" (float32) arrays for one block of outliers
     """
     filename = os.path.basename(nc_path)
-    tile_id  = filename.split("_")[0]
 
     with nc4.Dataset(nc_path, "r") as ds:
         if vi_type not in ds.variables:
@@ -109,136 +145,281 @@ def iter_tile_chunks(nc_path, vi_type, vmin, vmax):
             return
 
         time_vals   = ds.variables["time"][:]    # int32 days since 1970-01-01, shape (T,)
-        x_vals      = ds.variables["x"][:]       # native CRS metres, shape (W,)
-        y_vals      = ds.variables["y"][:]       # native CRS metres, shape (H,)
         sensor_vals = ds.variables["sensor"][:]  # S3, shape (T,)
-        n_times     = len(time_vals)
-
-        transformer = Transformer.from_crs(crs_wkt, "EPSG:4326", always_xy=True)
-
-        for t_start in range(0, n_times, TIME_CHUNK):
-            t_end = min(t_start + TIME_CHUNK, n_times)
-
-            # Load one chunk of the VI variable — shape (chunk, H, W)
-            raw_chunk  = ds.variables[vi_type][t_start:t_end, :, :]
-            data_chunk = (
-                raw_chunk.filled(np.nan) if hasattr(raw_chunk, "filled")
-                else np.array(raw_chunk, dtype=float)
-            )
-            del raw_chunk
-
-            # Outlier: finite value outside [vmin, vmax]
-            outlier_mask = (
-                np.isfinite(data_chunk) & ((data_chunk < vmin) | (data_chunk > vmax))
-            )
-            if not outlier_mask.any():
-                del data_chunk, outlier_mask
-                gc.collect()
+
+        # Regular grid of pixel centres (native CRS metres): x = x0 + i * dx,
+        # y = y0 + j * dy, so outlier coordinates are computed, not gathered
+        # (a one-pixel axis only ever has index 0, so its step is irrelevant)
+        x_head = np.asarray(ds.variables["x"][:2], dtype=np.float64)
+        y_head = np.asarray(ds.variables["y"][:2], dtype=np.float64)
+        x0, dx = x_head[0], x_head[-1] - x_head[0]
+        y0, dy = y_head[0], y_head[-1] - y_head[0]
+        n_x    = ds.variables["x"].shape[0]
+        n_y    = ds.variables["y"].shape[0]
+        n_px   = n_y * n_x
+
+        # Tile-wide lon/lat lookup tables, filled lazily for outlier pixels
+        # only. Large np.empty/np.zeros allocations are backed by untouched
+        # zero pages, so memory grows with the pixels actually transformed,
+        # not with H × W.
+        lon_lut  = np.empty(n_px, dtype=np.float64)
+        lat_lut  = np.empty(n_px, dtype=np.float64)
+        lut_done = np.zeros(n_px, dtype=bool)
+
+        # Per-time-step attributes, built once per tile and gathered by index
+        # (object arrays, so every gathered entry refers to the same few
+        # objects and pickles back to the main process as a memo reference).
+        # Dates are datetime.date, which fiona writes to the "date" field
+        # without parsing a string per record.
+        date_objs   = np.asarray(time_vals, dtype="int64").astype("datetime64[D]").astype(object)
+        sensor_strs = np.array([_decode_sensor(s) for s in sensor_vals], dtype=object)
+
+        transformer = _get_transformer(crs_wkt)
+
+        # Blocks follow the variable's HDF5 chunking (a time group × row band,
+        # TIME_CHUNK full frames for contiguous variables), shape (t, rows, W)
+        # float32 with NaN fill. They arrive time-group-major, so each group
+        # starts at y_start == 0 and the next group's first step follows it.
+        t0, t1 = t_range if t_range is not None else (0, len(time_vals))
+        t_start = t_next = t0
+        for y_start, data_chunk in iter_chunk_rows(ds.variables[vi_type],
+                                                   default=(TIME_CHUNK, n_y),
+                                                   t_index=np.arange(t0, t1)):
+            if y_start == 0:
+                t_start, t_next = t_next, t_next + data_chunk.shape[0]
+
+            # Outlier: finite value outside [vmin, vmax]. find_outliers counts
+            # and gathers them in two parallel passes over the chunk, without
+            # a chunk-sized boolean mask; a clean chunk stops after the
+            # counting pass, which is cheaper than a nanmin/nanmax pre-scan.
+            ct_idx, y_idx, x_idx, vi_values = find_outliers(data_chunk, vmin, vmax)
+            if not len(vi_values):
                 continue
+            t_global = ct_idx + t_start   # block-local → global time index
+            y_idx   += y_start            # block-local → tile row
+
+            # A pixel that is an outlier on several dates appears once per
+            # date: only pixels not yet in the tile's lookup table go through
+            # PROJ (each once), then every outlier reads its lon/lat from it.
+            # Contiguous float64 inputs go straight to PROJ without a copy.
+            flat = y_idx.astype(np.int64) * n_x + x_idx
+            new  = np.unique(flat[~lut_done[flat]])
+            if len(new):
+                lon_lut[new], lat_lut[new] = transformer.transform(
+                    x0 + dx * (new % n_x), y0 + dy * (new // n_x),
+                )
+                lut_done[new] = True
 
-            ct_idx, y_idx, x_idx = np.where(outlier_mask)
-            t_global = ct_idx + t_start   # chunk-local → global time index
+            # Vectorised gathers; fiona feature dicts are built by the writer
+            yield {
+                "lon":      lon_lut[flat],
+                "lat":      lat_lut[flat],
+                "date":     date_objs[t_global],
+                "sensor":   sensor_strs[t_global],
+                "vi_value": vi_values,
+            }
 
-            native_x = x_vals[x_idx]
-            native_y = y_vals[y_idx]
-            lon, lat = transformer.transform(native_x, native_y)
 
-            features = []
-            for i in range(len(ct_idx)):
-                date_str = str(
-                    (EPOCH + pd.Timedelta(days=int(time_vals[t_global[i]]))).date()
-                )
-                features.append({
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": (float(lon[i]), float(lat[i])),
-                    },
-                    "properties": {
-                        "tile_id":  tile_id,
-                        "vi_type":  vi_type,
-                        "sensor":   _decode_sensor(sensor_vals[t_global[i]]),
-                        "date":     date_str,
-                        "vi_value": float(data_chunk[ct_idx[i], y_idx[i], x_idx[i]]),
-                    },
-                })
-
-            yield features
-
-            del data_chunk, outlier_mask, features, lon, lat
-            gc.collect()
+def _time_groups(nc_path, vi_type):
+    """
+    Split one tile into (t0, t1) work items, one per HDF5 time chunk of its
+    VI variable (TIME_CHUNK steps for contiguous variables).
+
+    A tile without the VI (or without time steps) is still one item, so its
+    worker reports it like any other tile.
+    """
+    with nc4.Dataset(nc_path, "r") as ds:
+        if vi_type not in ds.variables:
+            return [(0, 0)]
+        vi_var = ds.variables[vi_type]
+        n_times, n_y = vi_var.shape[:2]
+        t_step = chunk_steps(vi_var, default=(TIME_CHUNK, n_y))[0]
+    return [(t0, min(t0 + t_step, n_times)) for t0 in range(0, n_times, t_step)] or [(0, 0)]
+
+
+def _process_tile(args):
+    """
+    Worker: reduce one time group of one NetCDF tile to its outlier columns.
+
+    Returns a dict with status 'ok' (and the group's concatenated columns,
+    possibly empty) or 'error'; never raises, so one bad tile does not stop
+    the pool. Columns are ~30 bytes per outlier, far smaller to pickle than
+    fiona feature dicts, which the main process builds as it writes; one
+    time group per result keeps that bounded however many outliers the
+    whole tile has.
+    """
+    nc_path  = args["nc_path"]
+    filename = os.path.basename(nc_path)
+    try:
+        set_worker_threads(N_WORKERS)
+        vmin, vmax = get_valid_range(args["vi_type"])
+        blocks = list(iter_tile_chunks(nc_path, args["vi_type"], vmin, vmax, args["t_range"]))
+        columns = {
+            name: np.concatenate([b[name] for b in blocks]) if blocks else np.empty(0)
+            for name in ("lon", "lat", "date", "sensor", "vi_value")
+        }
+        return {"status": "ok", "vi_type": args["vi_type"], "filename": filename,
+                "tile_id": filename.split("_")[0], "columns": columns}
+    except Exception as e:
+        return {"status": "error", "vi_type": args["vi_type"], "filename": filename,
+                "message": str(e)}
+
+
+def _iter_features(tile_id, vi_type, columns):
+    """Yield fiona feature dicts for one tile's outlier columns."""
+    for x, y, sensor, date, value in zip(
+        columns["lon"].tolist(), columns["lat"].tolist(),
+        columns["sensor"].tolist(), columns["date"].tolist(), columns["vi_value"].tolist(),
+    ):
+        yield {
+            "geometry": {"type": "Point", "coordinates": (x, y)},
+            "properties": {
+                "tile_id":  tile_id,
+                "vi_type":  vi_type,
+                "sensor":   sensor,
+                "date":     date,
+                "vi_value": value,
+            },
+        }
+
+
+def _report_vi(vi_type, out_path, total_outliers):
+    """Log one VI's result; remove its (closed) output file if it is empty."""
+    if total_outliers > 0:
+        logger.info(f"Wrote: {out_path}  ({total_outliers:,} features)")
+    else:
+        logger.info(f"No outliers found for {vi_type}.")
+        if os.path.exists(out_path):
+            os.remove(out_path)
 
 
 def main():
     if not INPUT_FOLDER or not OUTPUT_FOLDER:
         raise ValueError("NETCDF_DIR or OUTLIER_GPKG_DIR not set.")
+    if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        raise ValueError(f"OUTLIER_FORMAT must be one of {sorted(OUTPUT_FORMATS)}, "
+                         f"got '{OUTPUT_FORMAT}'.")
+    driver, extension, layer_options = OUTPUT_FORMATS[OUTPUT_FORMAT]
+    with fiona.Env() as env:
+        if driver not in env.drivers():
+            raise ValueError(f"OUTLIER_FORMAT={OUTPUT_FORMAT} needs GDAL's {driver} driver, "
+                             f"which this GDAL build does not include.")
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
     logger.info("Step 11: Outlier GeoPackage Export")
-    logger.info(f"  VIs        : {PROCESSED_VIS}  |  Time chunk: {TIME_CHUNK} slices")
+    logger.info(f"  Format     : {OUTPUT_FORMAT}")
+    logger.info(f"  VIs        : {PROCESSED_VIS}  |  Time chunk: {TIME_CHUNK} slices "
+                f"(contiguous NetCDF only)")
+    logger.info(f"  Workers    : {N_WORKERS}")
     logger.info(f"  Input dir  : {INPUT_FOLDER}")
     logger.info(f"  Output dir : {OUTPUT_FOLDER}")
     for vi in PROCESSED_VIS:
         vmin, vmax = get_valid_range(vi)
         logger.info(f"  Outlier threshold  {vi}: < {vmin} or > {vmax}")
 
-    all_nc = glob.glob(os.path.join(INPUT_FOLDER, "**", "*.nc"), recursive=True)
+    all_nc = list(find_files(INPUT_FOLDER, ".nc"))
     all_nc = filter_by_configured_tiles(all_nc)
     if not all_nc:
         logger.error(f"No NetCDF files found in: {INPUT_FOLDER}")
         return
 
+    nc_by_vi = group_by_vi(all_nc, PROCESSED_VIS)
+    vis = []
     for vi_type in PROCESSED_VIS:
-        vmin, vmax = get_valid_range(vi_type)
-        work_items = [
-            nc_path for nc_path in all_nc
-            if vi_type in os.path.basename(nc_path)
-        ]
-        if not work_items:
+        if nc_by_vi[vi_type]:
+            vis.append(vi_type)
+            logger.info(f"{vi_type}: {len(nc_by_vi[vi_type])} file(s)")
+        else:
             logger.warning(f"No NetCDF files matched for {vi_type}. Skipping.")
-            continue
-
-        out_path = os.path.join(OUTPUT_FOLDER, f"HLS_outliers_{vi_type}.gpkg")
-        if os.path.exists(out_path):
-            os.remove(out_path)
-
-        logger.info(f"Processing {vi_type}: {len(work_items)} file(s)")
-
-        total_outliers = 0
-        n_tiles = len(work_items)
-
-        # Open one GPKG file for the whole VI; each tile's chunks stream into it.
-        with fiona.open(
-            out_path, "w", driver="GPKG", schema=GPKG_SCHEMA, crs="EPSG:4326"
-        ) as dst:
-            for tile_idx, nc_path in enumerate(work_items, 1):
-                filename   = os.path.basename(nc_path)
-                n_tile_out = 0
-
-                logger.info(f"  [{tile_idx}/{n_tiles}] {filename}")
-
-                try:
-                    for chunk_features in iter_tile_chunks(nc_path, vi_type, vmin, vmax):
-                        dst.writerecords(chunk_features)
-                        n_tile_out += len(chunk_features)
-                except Exception as e:
-                    logger.error(f"    {e}")
-                    continue
-
-                total_outliers += n_tile_out
-                if n_tile_out > 0:
-                    logger.info(
-                        f"    {n_tile_out:,} outliers"
-                        f"  (running total: {total_outliers:,})"
-                    )
-                else:
-                    logger.info("    no outliers")
+    if not vis:
+        return
 
-        if total_outliers > 0:
-            logger.info(f"Wrote: {out_path}  ({total_outliers:,} features)")
-        else:
-            logger.info(f"No outliers found for {vi_type}.")
+    # One work item per (VI, tile, time group), so no single result holds a
+    # whole tile's outliers. Tiles are logged once all their groups are in.
+    worker_args = []
+    tile_parts  = {}
+    remaining   = {}
+    for vi_type in vis:
+        for nc_path in nc_by_vi[vi_type]:
+            try:
+                t_ranges = _time_groups(nc_path, vi_type)
+            except Exception as e:
+                logger.error(f"  {os.path.basename(nc_path)}: {e}")
+                continue
+            tile_parts[(vi_type, os.path.basename(nc_path))] = len(t_ranges)
+            remaining[vi_type] = remaining.get(vi_type, 0) + len(t_ranges)
+            worker_args.extend({"nc_path": nc_path, "vi_type": vi_type, "t_range": t_range}
+                               for t_range in t_ranges)
+    vis = [vi_type for vi_type in vis if vi_type in remaining]
+    if not vis:
+        return
+    tile_out  = dict.fromkeys(tile_parts, 0)
+    tile_err  = {}
+    totals    = dict.fromkeys(vis, 0)
+    batches   = {vi_type: [] for vi_type in vis}
+    n_total   = len(tile_parts)
+    n_done    = 0
+
+    # One output file per VI, all open for the whole run. The files are
+    # rebuilt from scratch on every run, so SQLite's per-commit fsync (GPKG)
+    # buys nothing — turn it off.
+    out_paths = {vi_type: os.path.join(OUTPUT_FOLDER, f"HLS_outliers_{vi_type}.{extension}")
+                 for vi_type in vis}
+    with ExitStack() as stack:
+        stack.enter_context(fiona.Env(OGR_SQLITE_SYNCHRONOUS="OFF"))
+        writers = {}
+        for vi_type, out_path in out_paths.items():
             if os.path.exists(out_path):
                 os.remove(out_path)
+            writers[vi_type] = stack.enter_context(fiona.open(
+                out_path, "w", driver=driver, schema=GPKG_SCHEMA, crs="EPSG:4326",
+                **layer_options,
+            ))
+
+        # One pool for every (VI, tile, time group) item (VI-major): workers
+        # extract in parallel while the main process is the only writer
+        # (GeoPackage/SQLite writes are serial). Each VI's file is closed as
+        # soon as its last item is written, while the pool works on the next VI.
+        with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
+            results = imap_bounded(executor, _process_tile, worker_args, 2 * N_WORKERS)
+            for result in results:
+                vi_type  = result["vi_type"]
+                filename = result["filename"]
+                key      = (vi_type, filename)
+                if result["status"] == "error":
+                    tile_err.setdefault(key, result["message"])
+                else:
+                    columns = result["columns"]
+                    batch   = batches[vi_type]
+                    for feature in _iter_features(result["tile_id"], vi_type, columns):
+                        batch.append(feature)
+                        if len(batch) >= WRITE_BATCH:
+                            writers[vi_type].writerecords(batch)
+                            batch.clear()
+                    tile_out[key]   += len(columns["vi_value"])
+                    totals[vi_type] += len(columns["vi_value"])
+                    del columns, result
+
+                tile_parts[key] -= 1
+                if tile_parts[key] == 0:
+                    n_done += 1
+                    n_tile_out = tile_out[key]
+                    if key in tile_err:
+                        logger.error(f"  [{n_done}/{n_total}] {filename}: {tile_err.pop(key)}")
+                    elif n_tile_out > 0:
+                        logger.info(
+                            f"  [{n_done}/{n_total}] {filename}  {n_tile_out:,} outliers"
+                            f"  ({vi_type} running total: {totals[vi_type]:,})"
+                        )
+                    else:
+                        logger.info(f"  [{n_done}/{n_total}] {filename}  no outliers")
+
+                remaining[vi_type] -= 1
+                if remaining[vi_type] == 0:
+                    if batches[vi_type]:
+                        writers[vi_type].writerecords(batches[vi_type])
+                    writers[vi_type].close()
+                    _report_vi(vi_type, out_paths[vi_type], totals[vi_type])
 
     logger.info("Step 11 complete.")
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# hls_kernels.py
+# Numba-compiled reduction kernels shared by the NetCDF-reading pipeline steps.
+#
+# Each kernel folds one (time, rows, cols) block of a VI cube into running
+# per-pixel accumulators, so callers can stream a NetCDF file one on-disk
+# chunk row at a time (see hls_utils.iter_chunk_rows) instead of loading or
+# masking the full (T, Y, X) cube.
+#
+# All kernels use error_model='numpy' and no fastmath: NaN (the NetCDF fill
+# value) must keep failing every comparison so it is never counted.
+#
+# Author:  Stephen Conklin <stephenconklin@gmail.com>
+#          https://github.com/stephenconklin
+# License: MIT
+
+import numba
+import numpy as np
+from numba import njit, prange
+
+from hls_utils import worker_threads
+
+# NetCDF fill values at or above this magnitude are treated as missing (step 05)
+FILL_THRESHOLD = 1e30
+
+
+def set_worker_threads(n_workers: int) -> None:
+    """Cap Numba threads in a pool worker at hls_utils.worker_threads(n_workers).
+
+    Call once at the top of each worker function so N worker processes do
+    not each spin up a full-size Numba thread pool.
+    """
+    numba.set_num_threads(min(numba.config.NUMBA_NUM_THREADS, worker_threads(n_workers)))
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def fused_stats_accumulate(block, vmin, vmax, total, count, valid):
+    """Outlier sum/count and valid count of *block* in one traversal.
+
+    Values < vmin or > vmax (and below FILL_THRESHOLD) are added to
+    total/count; values in [vmin, vmax] increment valid.
+    block: (t, rows, cols) float32; total: (rows, cols) float64;
+    count, valid: (rows, cols) integer. NaN never qualifies.
+    """
+    nt, ny, nx = block.shape
+    for i in prange(ny):
+        for t in range(nt):
+            for j in range(nx):
+                v = block[t, i, j]
+                if v >= vmin and v <= vmax:
+                    valid[i, j] += 1
+                elif v < FILL_THRESHOLD and (v < vmin or v > vmax):
+                    total[i, j] += v
+                    count[i, j] += 1
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def valid_count_accumulate(block, vmin, vmax, count):
+    """Add the number of in-range values (vmin <= v <= vmax) of *block* into count.
+
+    block: (t, rows, cols) float32; count: (rows, cols) integer.
+    NaN never qualifies.
+    """
+    nt, ny, nx = block.shape
+    for i in prange(ny):
+        for t in range(nt):
+            for j in range(nx):
+                v = block[t, i, j]
+                if v >= vmin and v <= vmax:
+                    count[i, j] += 1
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def range_sum_accumulate(block, vmin, vmax, total, count):
+    """Add the in-range values (vmin <= v <= vmax) of *block* into total/count.
+
+    The range test, sum and count are one traversal, with no boolean mask
+    or zero-filled copy of the block. NetCDF fill values and NaN fail the
+    range test, so no separate fill-value mask is needed.
+    block: (t, rows, cols) float32; total: (rows, cols) float64;
+    count: (rows, cols) integer.
+    """
+    nt, ny, nx = block.shape
+    for i in prange(ny):
+        for t in range(nt):
+            for j in range(nx):
+                v = block[t, i, j]
+                if v >= vmin and v <= vmax:
+                    total[i, j] += v
+                    count[i, j] += 1
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _saturate_uint16(src, dst):
+    n = src.size
+    for i in prange(n):
+        v = src[i]
+        if not v > 0:               # NaN, zero, negative
+            dst[i] = 0
+        elif v >= 65535:
+            dst[i] = 65535
+        else:
+            dst[i] = np.uint16(v)
+
+
+def to_uint16(counts):
+    """Return *counts* (any numeric dtype) as a uint16 array in one pass.
+
+    NaN and negative values become 0; values above 65535 saturate at 65535
+    instead of wrapping as ``astype('uint16')`` would.
+    """
+    src = np.ascontiguousarray(counts)
+    dst = np.empty(src.shape, dtype=np.uint16)
+    _saturate_uint16(src.ravel(), dst.ravel())
+    return dst
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def find_outliers(block, vmin, vmax):
+    """Indices and values of the finite out-of-range cells of *block*.
+
+    A counting pass sizes the outputs per (t, row) line, then a fill pass
+    writes each line's outliers at its prefix-sum offset, so no cube-sized
+    boolean mask is built. A block with no outliers costs the single
+    counting pass. Output order matches ``np.where`` (C order).
+    block: (t, rows, cols) float. Returns (t_idx, y_idx, x_idx) int32 arrays
+    and a values array of block's dtype. NaN, ±inf and fill values
+    (>= FILL_THRESHOLD) never qualify, so raw unmasked reads can be passed.
+    """
+    nt, ny, nx = block.shape
+    n_lines = nt * ny
+    line_counts = np.zeros(n_lines, dtype=np.int64)
+    for k in prange(n_lines):
+        t = k // ny
+        i = k - t * ny
+        c = 0
+        for j in range(nx):
+            v = block[t, i, j]
+            if (v < vmin or v > vmax) and np.isfinite(v) and v < FILL_THRESHOLD:
+                c += 1
+        line_counts[k] = c
+
+    offsets = np.empty(n_lines + 1, dtype=np.int64)
+    offsets[0] = 0
+    for k in range(n_lines):
+        offsets[k + 1] = offsets[k] + line_counts[k]
+    n_out = offsets[n_lines]
+
+    t_idx = np.empty(n_out, dtype=np.int32)
+    y_idx = np.empty(n_out, dtype=np.int32)
+    x_idx = np.empty(n_out, dtype=np.int32)
+    values = np.empty(n_out, dtype=block.dtype)
+    if n_out == 0:                  # clean block: skip the fill pass entirely
+        return t_idx, y_idx, x_idx, values
+    for k in prange(n_lines):
+        if line_counts[k] == 0:
+            continue
+        t = k // ny
+        i = k - t * ny
+        pos = offsets[k]
+        for j in range(nx):
+            v = block[t, i, j]
+            if (v < vmin or v > vmax) and np.isfinite(v) and v < FILL_THRESHOLD:
+                t_idx[pos] = t
+                y_idx[pos] = i
+                x_idx[pos] = j
+                values[pos] = v
+                pos += 1
+    return t_idx, y_idx, x_idx, values
@@ -9,6 +9,7 @@
 #          https://github.com/stephenconklin
 # License: MIT
 
+import functools
 import logging
 import os
 import sys
@@ -58,14 +59,16 @@ def setup_logging(step_name: str) -> logging.Logger:
 # Tile filtering
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
 def get_configured_tiles():
-    """Return the set of tile IDs from HLS_TILES env var, or empty set.
+    """Return the frozenset of tile IDs from HLS_TILES env var, or an empty one.
 
     An empty set means no tile filter is active (all tiles are processed),
     which preserves backward-compatible behaviour when HLS_TILES is unset.
+    Memoised: HLS_TILES is read and split once per process.
     """
     raw = os.environ.get("HLS_TILES", "").strip()
-    return set(raw.split()) if raw else set()
+    return frozenset(raw.split())
 
 
 def tile_id_from_path(filepath):
@@ -111,10 +114,60 @@ def filter_by_configured_tiles(filepaths):
     return [f for f in filepaths if tile_id_from_path(f) in configured]
 
 
+# ---------------------------------------------------------------------------
+# File discovery
+# ---------------------------------------------------------------------------
+
+def find_files(root, suffix):
+    """Yield paths of all files under *root* whose name ends with *suffix*.
+
+    Recursive ``os.scandir`` walk; a lighter equivalent of
+    ``glob.glob(os.path.join(root, "**", "*" + suffix), recursive=True)``
+    that yields paths as it goes instead of pattern-matching every entry
+    and building the full list first. Like glob, hidden entries (names
+    starting with '.') are skipped and directory symlinks are followed.
+    A missing *root* yields nothing.
+    """
+    try:
+        entries = os.scandir(root)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                yield from find_files(entry.path, suffix)
+            elif entry.name.endswith(suffix):
+                yield entry.path
+
+
+def group_by_vi(filepaths, vi_types):
+    """Group *filepaths* by the VI name found in each basename.
+
+    One pass with a single precompiled regex (longest names first, so e.g.
+    'EVI2' wins over 'EVI') instead of a substring scan per file per VI.
+    Returns ``{vi: [paths]}`` with an entry (possibly empty) for every VI in
+    *vi_types*; paths keep their input order and files naming no VI are
+    dropped.
+    """
+    import re
+    by_vi = {vi: [] for vi in vi_types}
+    if not by_vi:
+        return by_vi
+    pattern = re.compile('|'.join(map(re.escape, sorted(by_vi, key=len, reverse=True))))
+    for path in filepaths:
+        match = pattern.search(os.path.basename(path))
+        if match:
+            by_vi[match.group(0)].append(path)
+    return by_vi
+
+
 # ---------------------------------------------------------------------------
 # VI valid-range lookup
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
 def get_valid_range(vi_type: str) -> tuple:
     """Return (vmin, vmax) for a vegetation index from VALID_RANGE_{VI} env var.
 
@@ -122,7 +175,9 @@ def get_valid_range(vi_type: str) -> tuple:
     Format:      "min,max"  e.g. "-1,1"
 
     Falls back to conservative per-VI defaults when the variable is absent or
-    cannot be parsed, and logs a warning in that case.
+    cannot be parsed, and logs a warning in that case. Cached per process:
+    the environment is fixed for a step run, so each VI is parsed (and any
+    warning logged) once.
     """
     defaults = {"NDVI": (-1.0, 1.0), "EVI2": (-1.0, 2.0), "NIRv": (-0.5, 1.0)}
     raw = os.environ.get(f"VALID_RANGE_{vi_type}", "")
@@ -142,6 +197,7 @@ def get_valid_range(vi_type: str) -> tuple:
 # Reproject resolution (CRS-unit-aware)
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
 def reproject_resolution(target_crs: str, meters: float = 30.0) -> float:
     """Return the reproject resolution in target CRS units for a desired ground
     resolution in metres.
@@ -169,28 +225,400 @@ def reproject_resolution(target_crs: str, meters: float = 30.0) -> float:
 
 
 # ---------------------------------------------------------------------------
-# CRS detection (xarray / rioxarray datasets)
+# Array reprojection (plain numpy, no xarray/rioxarray)
+# ---------------------------------------------------------------------------
+
+def transform_from_coords(x_coords, y_coords):
+    """Return the affine transform of a regular grid given its pixel-center coordinates.
+
+    Inverse of the pixel-center convention used in step 03
+    (center = corner + size * (i + 0.5)).
+    """
+    from affine import Affine
+    dx = float(x_coords[1] - x_coords[0]) if len(x_coords) > 1 else 1.0
+    dy = float(y_coords[1] - y_coords[0]) if len(y_coords) > 1 else -1.0
+    return Affine(dx, 0.0, float(x_coords[0]) - dx / 2, 0.0, dy, float(y_coords[0]) - dy / 2)
+
+
+def default_dst_grid(src_crs, src_transform, src_shape, dst_crs, resolution):
+    """Return ``(dst_transform, (height, width))`` for reprojecting a source grid.
+
+    Same grid ``DataArray.rio.reproject`` derives (``calculate_default_transform``
+    over the source bounds). Results are memoised per process on the source
+    CRS, transform and shape, so the PROJ work runs once per tile rather
+    than once per VI and per output layer. CRS arguments may be strings
+    (EPSG code / WKT, used as-is for the cache key) or rasterio CRS objects.
+    """
+    def _key(crs):
+        return crs if isinstance(crs, str) else crs.to_wkt()
+
+    return _default_dst_grid(_key(src_crs), tuple(src_transform)[:6], tuple(src_shape),
+                             _key(dst_crs), resolution)
+
+
+@functools.lru_cache(maxsize=4096)
+def _default_dst_grid(src_wkt, src_transform, src_shape, dst_wkt, resolution):
+    from affine import Affine
+    from rasterio.transform import array_bounds
+    from rasterio.warp import calculate_default_transform
+
+    height, width = src_shape
+    west, south, east, north = array_bounds(height, width, Affine(*src_transform))
+    dst_transform, dst_width, dst_height = calculate_default_transform(
+        src_wkt, dst_wkt, width, height, west, south, east, north, resolution=resolution,
+    )
+    return dst_transform, (dst_height, dst_width)
+
+
+def reproject_array(arr, src_transform, src_crs, dst_crs, resolution,
+                    nodata=float('nan'), src_nodata=None, resampling='nearest', num_threads=1,
+                    warp_mem_limit=0, dst_grid=None):
+    """Reproject a 2-D numpy array to *dst_crs* at *resolution*.
+
+    The destination grid is chosen the same way ``DataArray.rio.reproject``
+    chooses it (``calculate_default_transform`` over the source bounds), so
+    outputs are pixel-identical to the rioxarray path, without the xarray
+    and dask overhead. The destination buffer is allocated uninitialised;
+    the warper itself fills it with *nodata* (INIT_DEST=NO_DATA) before
+    writing valid pixels, so no separate fill pass is made.
+
+    The destination grid comes from ``default_dst_grid`` (cached per source
+    grid, so every VI of a tile reuses it); pass
+    ``dst_grid=(dst_transform, dst_shape)`` to supply it explicitly.
+
+    *num_threads* and *warp_mem_limit* (MB, 0 = GDAL default) are passed to
+    the GDAL warper; inside pool workers use ``worker_threads(N_WORKERS)``.
+
+    Returns:
+        (dst_array, dst_transform)
+    """
+    import numpy as np
+    from rasterio.warp import Resampling, reproject
+
+    if dst_grid is None:
+        dst_grid = default_dst_grid(src_crs, src_transform, arr.shape, dst_crs, resolution)
+    dst_transform, dst_shape = dst_grid
+    dst = np.empty(dst_shape, dtype=arr.dtype)
+    reproject(
+        arr, dst,
+        src_transform=src_transform, src_crs=src_crs, src_nodata=src_nodata,
+        dst_transform=dst_transform, dst_crs=dst_crs, dst_nodata=nodata, init_dest_nodata=True,
+        resampling=Resampling[resampling], num_threads=num_threads,
+        warp_mem_limit=warp_mem_limit,
+    )
+    return dst, dst_transform
+
+
+# ---------------------------------------------------------------------------
+# NetCDF block reads and CRS detection (netCDF4)
 # ---------------------------------------------------------------------------
 
-def detect_crs(ds, da):
-    """Try multiple CRS detection paths on an xarray Dataset/DataArray pair.
+def chunk_steps(var, default=(32, 512)):
+    """Return the ``(time, rows)`` HDF5 chunk steps of a (time, y, x) netCDF4 variable.
+
+    *default* is returned for contiguous variables.
+    """
+    chunking = var.chunking()
+    return tuple(default) if chunking == 'contiguous' else tuple(chunking[:2])
+
+
+def iter_chunk_rows(var, default=(32, 512), t_index=None):
+    """Yield ``(y0, block)`` over a (time, y, x) netCDF4 variable, one chunk row at a time.
+
+    Each block is ``var[t0:t1, y0:y1, :]`` aligned to the variable's HDF5
+    chunking (a time group × row band), so every chunk is decompressed once
+    and memory stays at one block. *default* gives (time, rows) for
+    contiguous variables. Auto-masking is switched off: NaN is the fill
+    value, so plain float arrays are returned.
+
+    *t_index* (sorted time indices) restricts the blocks to those time
+    steps: each time group is read as the span of its selected steps, and
+    groups with none selected are not read at all.
+    """
+    import numpy as np
+    var.set_auto_mask(False)
+    n_t, n_y, _ = var.shape
+    t_step, y_step = chunk_steps(var, default)
+    for t0 in range(0, n_t, t_step):
+        if t_index is None:
+            t_lo, t_hi, pick = t0, t0 + t_step, None
+        else:
+            sel = t_index[(t_index >= t0) & (t_index < t0 + t_step)]
+            if not len(sel):
+                continue
+            t_lo, t_hi = int(sel[0]), int(sel[-1]) + 1
+            pick = None if len(sel) == t_hi - t_lo else sel - t_lo
+        for y0 in range(0, n_y, y_step):
+            block = var[t_lo:t_hi, y0:y0 + y_step, :]
+            yield y0, (block if pick is None else np.ascontiguousarray(block[pick]))
+
+
+def detect_nc_crs(nc, var):
+    """Return the CRS WKT of a netCDF4 Dataset/Variable pair.
 
     Checks, in order:
-      1. da.rio.crs          (rioxarray spatial_ref coordinate)
-      2. ds.attrs['crs']     (global NetCDF attribute written by step 03)
-      3. data-var attributes 'crs_wkt' / 'spatial_ref'
+      1. the variable's ``grid_mapping`` variable ('crs_wkt' / 'spatial_ref')
+      2. the global 'crs' attribute (written by step 03)
+      3. 'crs_wkt' / 'spatial_ref' attributes on any variable
 
-    Returns the first CRS found, or None if none is detected.
-    Requires rioxarray to be imported in the calling module (noqa import).
+    Returns the WKT string found, or None.
     """
-    crs = da.rio.crs
-    if crs:
-        return crs
-    crs = ds.attrs.get('crs')
+    gm = getattr(var, 'grid_mapping', None)
+    if gm and gm in nc.variables:
+        crs = getattr(nc.variables[gm], 'crs_wkt', None) or getattr(nc.variables[gm], 'spatial_ref', None)
+        if crs:
+            return crs
+    crs = getattr(nc, 'crs', None)
     if crs:
         return crs
-    for var in ds.data_vars:
-        crs = ds[var].attrs.get('crs_wkt') or ds[var].attrs.get('spatial_ref')
+    for v in nc.variables.values():
+        crs = getattr(v, 'crs_wkt', None) or getattr(v, 'spatial_ref', None)
         if crs:
             return crs
     return None
+
+
+# ---------------------------------------------------------------------------
+# Shared-memory arrays for worker processes
+# ---------------------------------------------------------------------------
+
+def share_array(arr):
+    """Copy a numpy array into a new ``multiprocessing.shared_memory`` block.
+
+    Returns ``(shm, spec)``. Pass the small, picklable *spec*
+    ``(name, shape, dtype_str)`` to workers instead of the array itself and
+    read it there with read_shared_array(). The caller owns *shm* and must
+    ``close()`` and ``unlink()`` it once all workers are done.
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    view[...] = arr
+    del view     # drop the export so shm.close() can release the buffer
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def read_shared_array(spec):
+    """Return a private copy of the array described by a share_array() *spec*."""
+    import numpy as np
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+
+# ---------------------------------------------------------------------------
+# GeoTIFF creation options
+# ---------------------------------------------------------------------------
+
+# Codecs that accept a TIFF predictor
+_PREDICTOR_CODECS = {'LZW', 'DEFLATE', 'ZSTD', 'LZMA'}
+
+
+def geotiff_options(dtype, compress=None) -> dict:
+    """Return GTiff creation options for a pipeline output of *dtype*.
+
+    Codec from GEOTIFF_COMPRESS (default ZSTD, level 1 — fast to encode and
+    smaller than LZW on float32), tiled GEOTIFF_BLOCK_SIZE blocks, and the
+    predictor matching the data: 3 (floating-point) for float rasters, 2
+    (horizontal differencing) for integer counts. Unpack into
+    ``rasterio.open(..., **geotiff_options(dtype))`` or a profile.
+
+    *compress* overrides the codec; ``compress='NONE'`` gives uncompressed
+    tiles for temporary files that are read back once and re-encoded.
+    """
+    import numpy as np
+    compress = (compress or os.environ.get("GEOTIFF_COMPRESS", "ZSTD")).upper()
+    block    = int(os.environ.get("GEOTIFF_BLOCK_SIZE", 512))
+    options  = dict(compress=compress, tiled=True, blockxsize=block, blockysize=block)
+    if compress in _PREDICTOR_CODECS:
+        options['predictor'] = 3 if np.dtype(dtype).kind == 'f' else 2
+    if compress == 'ZSTD':
+        options['zstd_level'] = 1
+    return options
+
+
+# ---------------------------------------------------------------------------
+# Streaming mosaics
+# ---------------------------------------------------------------------------
+
+def streaming_merge(tile_paths, dst_path, nodata, dtype, description=None, num_threads=None,
+                    **creation_options):
+    """Mosaic single-band GeoTIFF tiles into *dst_path* one output block at a time.
+
+    Reproduces ``rasterio.merge.merge(..., nodata=nodata)`` with the default
+    'first' method: the output grid is the union of the tile bounds at the
+    first tile's resolution, each tile is placed at its rounded offset (as in
+    gdal_merge.py) and fills only pixels no earlier tile has filled. Instead
+    of allocating the whole mosaic, each output block is assembled from
+    windowed reads of just the tiles that overlap it, so peak RAM is one
+    block per overlapping tile. *creation_options* (compress, tiled,
+    blockxsize, blockysize, predictor, ...) are passed to the GTiff writer.
+
+    Blocks are assembled on *num_threads* threads (default: all cores) and
+    written in order by the calling thread; at most two blocks per thread
+    are in flight. rasterio datasets are not thread-safe, so each tile's
+    reads are serialised by a per-tile lock (different tiles read in
+    parallel).
+    """
+    import math
+    from threading import Lock
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import islice
+
+    import numpy as np
+    import rasterio
+    from affine import Affine
+    from rasterio.windows import Window, from_bounds
+
+    num_threads = num_threads or worker_threads(1)
+    locks = [Lock() for _ in tile_paths]
+    src_files = []
+    try:
+        for p in tile_paths:
+            src_files.append(rasterio.open(p))
+        res = src_files[0].res
+        bounds = [src.bounds for src in src_files]
+        west, south = min(b.left for b in bounds), min(b.bottom for b in bounds)
+        east, north = max(b.right for b in bounds), max(b.top for b in bounds)
+        transform = Affine.translation(west, north) * Affine.scale(res[0], -res[1])
+        profile = dict(
+            driver='GTiff', count=1, dtype=dtype, nodata=nodata, crs=src_files[0].crs,
+            width=int(round((east - west) / res[0])), height=int(round((north - south) / res[1])),
+            transform=transform, **creation_options,
+        )
+        nodata_is_nan = isinstance(nodata, float) and math.isnan(nodata)
+
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            # Each tile's footprint in the mosaic, rounded as rasterio.merge does,
+            # and the tiles (in merge order) touching each output block.
+            block_h, block_w = dst.block_shapes[0]
+            footprints, by_block = [], {}
+            for idx, src in enumerate(src_files):
+                w = from_bounds(*src.bounds, transform)
+                fp = Window(math.floor(w.col_off + 0.1), math.floor(w.row_off + 0.1),
+                            math.floor(w.width + 0.5), math.floor(w.height + 0.5))
+                footprints.append(fp)
+                for bi in range(max(fp.row_off, 0) // block_h,
+                                (min(fp.row_off + fp.height, dst.height) - 1) // block_h + 1):
+                    for bj in range(max(fp.col_off, 0) // block_w,
+                                    (min(fp.col_off + fp.width, dst.width) - 1) // block_w + 1):
+                        by_block.setdefault((bi, bj), []).append(idx)
+
+            def _assemble(item):
+                ij, win = item
+                block = np.full((win.height, win.width), nodata, dtype=dtype)
+                for idx in by_block.get(ij, ()):
+                    src, fp = src_files[idx], footprints[idx]
+                    r0, r1 = max(win.row_off, fp.row_off), min(win.row_off + win.height, fp.row_off + fp.height)
+                    c0, c1 = max(win.col_off, fp.col_off), min(win.col_off + win.width, fp.col_off + fp.width)
+                    if r0 >= r1 or c0 >= c1:
+                        continue
+                    # Nearest-neighbour source pixels for this part of the footprint
+                    # (GDAL's mapping when a tile is read at out_shape = footprint)
+                    rows = ((np.arange(r0, r1) - fp.row_off + 0.5) * (src.height / fp.height)).astype(int)
+                    cols = ((np.arange(c0, c1) - fp.col_off + 0.5) * (src.width / fp.width)).astype(int)
+                    read_win = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+                    with locks[idx]:
+                        data = src.read(1, window=read_win, masked=True)
+                    take = np.ix_(rows - rows[0], cols - cols[0])
+                    values, valid = data.data[take], ~np.ma.getmaskarray(data)[take]
+                    region = block[r0 - win.row_off:r1 - win.row_off, c0 - win.col_off:c1 - win.col_off]
+                    empty = np.isnan(region) if nodata_is_nan else region == nodata
+                    np.copyto(region, values, where=empty & valid, casting='unsafe')
+                return win, block
+
+            windows = dst.block_windows(1)
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                while True:
+                    batch = list(islice(windows, 2 * num_threads))
+                    if not batch:
+                        break
+                    for win, block in pool.map(_assemble, batch):
+                        dst.write(block, 1, window=win)
+            if description:
+                dst.set_band_description(1, description)
+    finally:
+        for src in src_files:
+            src.close()
+
+
+# ---------------------------------------------------------------------------
+# Per-worker thread budget
+# ---------------------------------------------------------------------------
+
+def worker_threads(n_workers: int) -> int:
+    """Threads one pool worker may use: cpu_count // n_workers, minimum 1.
+
+    Used for GDAL warp threads and Numba kernels so N worker processes
+    together stay within the machine's cores.
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+
+def imap_bounded(executor, fn, items, max_in_flight):
+    """Yield ``fn(item)`` results from *executor* in completion order.
+
+    Like ``Pool.imap_unordered``, but for a ``concurrent.futures`` executor:
+    at most *max_in_flight* items are submitted at any time (a sliding
+    window refilled as results arrive), so pickled arguments and pending
+    futures stay O(workers) rather than O(work items).
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    in_flight = set()
+    for item in items:
+        in_flight.add(executor.submit(fn, item))
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+# ---------------------------------------------------------------------------
+# GDAL environment for raster readers/writers
+# ---------------------------------------------------------------------------
+
+def gdal_env(n_workers: int = 1, **options):
+    """Return a ``rasterio.Env`` with the pipeline's GDAL settings for local GeoTIFF I/O.
+
+    - GDAL_CACHEMAX: block cache budget, 512 MB instead of GDAL's default
+      5 % of RAM, split evenly across *n_workers* processes. A GDAL_CACHEMAX
+      environment variable takes precedence (numbers < 100000 are MB, as in
+      GDAL; non-numeric values such as "10%" are left for GDAL to read).
+    - GDAL_NUM_THREADS: ALL_CPUS in the main process, worker_threads(n_workers)
+      inside pool workers, so ZSTD/DEFLATE (de)compression is multi-threaded
+      without oversubscribing the machine.
+    - GDAL_DISABLE_READDIR_ON_OPEN=EMPTY_DIR: skip the sidecar-file directory
+      listing on every open (HLS folders hold thousands of siblings).
+    - CPL_VSIL_CURL_ALLOWED_EXTENSIONS=.tif: same for any /vsicurl/ reads.
+    - CHECK_DISK_FREE_SPACE=NO, GDAL_TIFF_INTERNAL_MASK=YES.
+
+    Keyword arguments override or extend these options. Use as
+    ``with gdal_env(N_WORKERS): ...`` in worker functions and
+    ``with gdal_env(): ...`` around mosaics in the main process.
+    """
+    import rasterio
+    n_workers = max(1, n_workers)
+    settings = {
+        'GDAL_NUM_THREADS': 'ALL_CPUS' if n_workers == 1 else str(worker_threads(n_workers)),
+        'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+        'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+        'CHECK_DISK_FREE_SPACE': 'NO',
+        'GDAL_TIFF_INTERNAL_MASK': 'YES',
+    }
+    # rasterio passes GDAL_CACHEMAX to GDALSetCacheMax64, which takes bytes
+    raw = os.environ.get('GDAL_CACHEMAX', '512').strip()
+    if raw.isdigit():
+        cache = int(raw) * 1024 ** 2 if int(raw) < 100_000 else int(raw)
+        settings['GDAL_CACHEMAX'] = cache // n_workers
+    settings.update(options)
+    return rasterio.Env(**settings)